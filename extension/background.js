@@ -6,7 +6,8 @@
 // API endpoint configuration
 const API_CONFIG = {
   baseUrl: 'http://127.0.0.1:8000',
-  getSummaryEndpoint: '/get_summary'
+  getSummaryEndpoint: '/get_summary',
+  lookupEndpoint: '/lookup'
 };
 
 // State management
@@ -161,6 +162,8 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
     throw new Error('No tab ID provided');
   }
 
+  let knownSummary = null;
+
   try {
     // Get the current user's preferred language or use the specified one
     const { preferredLanguage = 'English' } = await chrome.storage.sync.get(['preferredLanguage']);
@@ -176,6 +179,22 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
       console.log('Could not send loading message');
     }
 
+    // Show the latest known summary for this URL right away; it is verified against the page content below
+    const tab = await chrome.tabs.get(tabId).catch(() => null);
+    knownSummary = tab?.url ? await fetchSummaryByUrl(tab.url, language) : null;
+    if (knownSummary) {
+      await chrome.tabs.sendMessage(tabId, {
+        action: 'showSummary',
+        summary: {
+          ...knownSummary.summary,
+          domain: new URL(tab.url).hostname,
+          url: tab.url,
+          language,
+          fromCache: true
+        }
+      }).catch(() => console.log('Content script may not be ready yet'));
+    }
+
     // Execute content script to extract the page content
     const results = await chrome.scripting.executeScript({
       target: { tabId },
@@ -218,14 +237,16 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
     // Store the current page data for later use
     currentPageData = result;
 
-    // Update the loading message
-    try {
-      await chrome.tabs.sendMessage(tabId, {
-        action: 'updateLoadingStatus',
-        message: `Generating summary in ${language}...`
-      }).catch(() => console.log('Content script may not be ready yet'));
-    } catch (e) {
-      console.log('Could not send loading update');
+    // Update the loading message, unless a known summary is already on screen
+    if (!knownSummary) {
+      try {
+        await chrome.tabs.sendMessage(tabId, {
+          action: 'updateLoadingStatus',
+          message: `Generating summary in ${language}...`
+        }).catch(() => console.log('Content script may not be ready yet'));
+      } catch (e) {
+        console.log('Could not send loading update');
+      }
     }
 
     // Fetch summary from API
@@ -233,7 +254,8 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
       result.content,
       result.domain,
       result.url,
-      language
+      language,
+      { silent: Boolean(knownSummary) }
     );
 
     // Add the extracted content to the summary object
@@ -242,6 +264,15 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
     summary.url = result.url;
     summary.language = language;
 
+    // The page has not changed since the known summary was made, so keep it on screen
+    if (knownSummary && summary.contentHash === knownSummary.content_hash) {
+      await chrome.tabs.sendMessage(tabId, {
+        action: 'attachPageContent',
+        content: result.content
+      }).catch(() => console.log('Could not attach page content'));
+      return { success: true, summary };
+    }
+
     // Show the summary in the content script
     await chrome.tabs.sendMessage(tabId, {
       action: 'showSummary',
@@ -253,6 +284,11 @@ async function summarizeCurrentPage(tabId, specifiedLanguage = null) {
     return { success: true, summary };
   } catch (error) {
     console.error('Error in summarizeCurrentPage:', error);
+
+    // A failed verification should not replace the known summary already on screen
+    if (knownSummary) {
+      return { success: true, summary: knownSummary.summary };
+    }
     
     // Try to show error in content script
     try {
@@ -317,8 +353,36 @@ async function summarizeExternalPage(url, tabId, language = 'English') {
   return summarizeCurrentPage(tabId, language);
 }
 
-// Fetch summary from the Yoola API
-async function fetchSummaryFromAPI(content, domain, url, language = 'English') {
+// Anonymous id of this installation, sent as X-Yoola-Client so the server can break down usage per installation
+async function getClientId() {
+  const { clientId } = await chrome.storage.local.get(['clientId']);
+  if (clientId) {
+    return clientId;
+  }
+  const newClientId = crypto.randomUUID();
+  await chrome.storage.local.set({ clientId: newClientId });
+  return newClientId;
+}
+
+// Look up the latest known summary for a URL without sending the page content.
+// Resolves to { summary, content_hash, matched_by, stale } or null if the server knows nothing.
+async function fetchSummaryByUrl(url, language = 'English') {
+  try {
+    const params = new URLSearchParams({ url, language });
+    const response = await fetch(`${API_CONFIG.baseUrl}${API_CONFIG.lookupEndpoint}?${params.toString()}`);
+    if (!response.ok) {
+      return null;
+    }
+    return await response.json();
+  } catch (error) {
+    console.log('URL lookup failed, falling back to content extraction:', error);
+    return null;
+  }
+}
+
+// Fetch summary from the Yoola API.
+// With options.silent no loading or caching status is shown, e.g. while verifying a summary already on screen.
+async function fetchSummaryFromAPI(content, domain, url, language = 'English', options = {}) {
   // Validate required parameters
   if (!content || content === 'undefined') {
     throw new Error('No content provided for summarization');
@@ -344,13 +408,15 @@ async function fetchSummaryFromAPI(content, domain, url, language = 'English') {
 
   try {
     // Show loading state in the popup if it's open
-    chrome.runtime.sendMessage({ action: 'setLoading', isLoading: true });
+    if (!options.silent) {
+      chrome.runtime.sendMessage({ action: 'setLoading', isLoading: true });
+    }
 
     // Start a timer to check if this is taking longer than 2 seconds
     const timeoutPromise = new Promise(resolve => {
       setTimeout(() => {
         // If still waiting after 2 seconds, it's likely generating a new summary
-        if (!isCachingStatus) {
+        if (!isCachingStatus && !options.silent) {
           isCachingStatus = true;
           chrome.runtime.sendMessage({ 
             action: 'cachingStatus', 
@@ -389,10 +455,19 @@ async function fetchSummaryFromAPI(content, domain, url, language = 'English') {
     });
     
     const fullApiUrl = `${apiUrl}?${params.toString()}`;
-    const response = await fetch(fullApiUrl);
+    const response = await fetch(fullApiUrl, {
+      headers: { 'X-Yoola-Client': await getClientId() }
+    });
     
     if (!response.ok) {
-      throw new Error(`API request failed with status ${response.status}`);
+      // Failed summaries come back as { detail: { reason, message } } with a Retry-After header
+      const errorBody = await response.json().catch(() => null);
+      const retryAfter = response.headers.get('Retry-After');
+      let message = errorBody?.detail?.message || `API request failed with status ${response.status}`;
+      if (retryAfter) {
+        message += ` Please try again in ${retryAfter} seconds.`;
+      }
+      throw new Error(message);
     }
     
     const data = await response.json();
@@ -401,6 +476,9 @@ async function fetchSummaryFromAPI(content, domain, url, language = 'English') {
       throw new Error('No data returned from API');
     }
     
+    // Lets callers compare against the content_hash of a summary found by URL lookup
+    data.contentHash = response.headers.get('X-Yoola-Content-Hash');
+
     // Calculate how long the request took
     const requestTime = Date.now() - requestStartTime;
     data.generationTime = requestTime;
@@ -57,6 +57,10 @@ if (window.yoolaAlreadyInjected) {
         } else if (message.action === 'hideLoadingOverlay') {
           this.hideLoadingOverlay();
           sendResponse({ success: true });
+        } else if (message.action === 'attachPageContent') {
+          // Summaries shown from a URL lookup arrive before the page content has been extracted
+          this.pageContent = message.content;
+          sendResponse({ success: true });
         }
         return true; // Keep the message channel open for async responses
       } catch (error) {
@@ -426,7 +430,7 @@ if (window.yoolaAlreadyInjected) {
         language: selectedLanguage,
         domain: summary.domain,
         url: summary.url,
-        content: summary.content
+        content: summary.content || this.pageContent
       }, (response) => {
         this.hideLoadingOverlay();
         if (response && response.summary) {
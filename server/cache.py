@@ -0,0 +1,171 @@
+"""
+In-memory caches for Yoola
+Keeps hot summaries in memory so they are served without a database read, and keeps recent
+summarization failures out of the database and stops them from being retried on every request
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from openrouter_api import OVERSIZED, UPSTREAM_UNAVAILABLE, TIMED_OUT, INVALID_OUTPUT
+
+logger = logging.getLogger(__name__)
+
+# (initial backoff, maximum backoff) in seconds for each failure reason.
+# The backoff doubles with every consecutive failure of the same document.
+NEGATIVE_CACHE_BACKOFF = {
+    # The same content will be just as large next time
+    OVERSIZED: (3600, 24 * 3600),
+    # Outages are usually short, so probe again soon
+    UPSTREAM_UNAVAILABLE: (15, 300),
+    # A document that took too long twice will likely take too long again soon
+    TIMED_OUT: (120, 3600),
+    # The model keeps producing output we cannot use for this document
+    INVALID_OUTPUT: (300, 6 * 3600),
+}
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("YOOLA_SUMMARY_CACHE_MAX_ENTRIES", "5000"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("YOOLA_NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+# Upstream outages (connection errors, 5xx, missing API key) affect every document,
+# so they back off under a single key
+UPSTREAM_KEY = ("*", "*")
+
+class SummaryCache:
+    """
+    LRU cache of stored summaries keyed by (content_hash, language), holding the same
+    summary, model and prompt_version dicts as get_summary_entry returns
+    """
+
+    def __init__(self, max_entries: int = SUMMARY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def put(self, key: Tuple[str, str], entry: Dict[str, Any]):
+        """Remember entry for key, evicting the least recently used entries beyond max_entries"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def preload(self, entries: Iterable[Dict[str, Any]]) -> int:
+        """
+        Fill the cache from get_hot_summaries-style dicts, most requested first,
+        without replacing anything cached by requests in the meantime
+
+        Returns:
+            The number of entries added
+        """
+        # A missing summary would be served as a hit; leave those to the database
+        entries = [entry for entry in entries if entry.get("summary") is not None][:max(self.max_entries, 0)]
+        added = 0
+        with self._lock:
+            # Preloaded entries go behind anything requested already, the least requested evicted first
+            for entry in entries:
+                key = (entry["content_hash"], entry["language"])
+                if key in self._entries:
+                    continue
+                self._entries[key] = {field: entry[field] for field in ("summary", "model", "prompt_version")}
+                self._entries.move_to_end(key, last=False)
+                added += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return added
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+class NegativeCache:
+    """
+    Short-lived record of documents that recently failed to summarize, with per-reason backoff
+    """
+
+    def __init__(self, max_entries: int = NEGATIVE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key -> (reason, consecutive failures, expires at, forgotten at)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, int, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record_failure(self, key: Tuple[str, str], reason: str) -> float:
+        """
+        Remember that summarizing key failed
+
+        Args:
+            key: The (content_hash, language) pair that failed
+            reason: One of the failure reasons from openrouter_api. Upstream outages are
+                recorded under UPSTREAM_KEY rather than key.
+
+        Returns:
+            The number of seconds clients should wait before retrying
+        """
+        if reason == UPSTREAM_UNAVAILABLE:
+            key = UPSTREAM_KEY
+        initial, maximum = NEGATIVE_CACHE_BACKOFF.get(reason, NEGATIVE_CACHE_BACKOFF[INVALID_OUTPUT])
+        now = time.monotonic()
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            # Failures only count as consecutive while the previous entry is remembered
+            failures = previous[1] + 1 if previous and previous[0] == reason and previous[3] > now else 1
+            ttl = min(initial * 2 ** (failures - 1), maximum)
+            self._entries[key] = (reason, failures, now + ttl, now + 2 * ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logger.info(f"Negative cache: {key} failed with '{reason}' ({failures} in a row), backing off {ttl:.0f} seconds")
+        return ttl
+
+    def get(self, key: Tuple[str, str]) -> Optional[Tuple[str, float]]:
+        """
+        Return (reason, seconds until retry) if key or the upstream is still backing off, None otherwise
+        """
+        return self._get(key) or self._get(UPSTREAM_KEY)
+
+    def _get(self, key: Tuple[str, str]) -> Optional[Tuple[str, float]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            reason, _, expires_at, forget_at = entry
+            if forget_at <= now:
+                del self._entries[key]
+                return None
+        if expires_at <= now:
+            return None
+        return reason, expires_at - now
+
+    def record_success(self, key: Tuple[str, str]):
+        """Forget key and any upstream outage after key was summarized successfully"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries.pop(UPSTREAM_KEY, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Number of documents currently backing off, per reason"""
+        now = time.monotonic()
+        counts = {reason: 0 for reason in NEGATIVE_CACHE_BACKOFF}
+        with self._lock:
+            for reason, _, expires_at, _ in self._entries.values():
+                if expires_at > now:
+                    counts[reason] = counts.get(reason, 0) + 1
+        return counts
+
+summary_cache = SummaryCache()
+negative_cache = NegativeCache()
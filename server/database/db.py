@@ -9,24 +9,72 @@ import sqlite3
 import hashlib
 import logging
 import time
-from typing import Dict, Any, Optional, List
-
-# Setup logging with more detail
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from typing import Dict, Any, Optional, List, Iterable, Tuple
+
 logger = logging.getLogger(__name__)
 
 # SQLite database settings
 DB_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(DB_DIR, "yoola.db")
+# How long a starting process waits for another one that is setting up the schema
+SCHEMA_LOCK_TIMEOUT = float(os.getenv("YOOLA_SCHEMA_LOCK_TIMEOUT", "30"))
+
+# Prefixes of the SQLite errors caused by a malformed FTS5 query rather than by the server
+FTS_QUERY_ERRORS = ("fts5:", "unterminated string", "no such column", "unknown special query")
+
+# Schema setup runs once per process, see ensure_schema
+_schema_migrated = False
+_schema_lock = threading.Lock()
+
+def compute_content_hash(content: str) -> str:
+    """
+    Compute the MD5 fingerprint used as the cache key for ToS content
+    """
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
 
-# Ensure the database directory exists
-os.makedirs(DB_DIR, exist_ok=True)
+# Whether SQLite supports FTS5; set when the schema is migrated
+search_available = False
 
-logger.info(f"Database path set to: {DB_PATH}")
+# Query parameters that only track where a visitor came from and never change the page
+TRACKING_QUERY_PARAMS = {"fbclid", "gclid", "msclkid", "yclid", "mc_cid", "mc_eid", "ref", "_ga"}
+
+def canonicalize_url(url: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Reduce a URL to the keys used for URL lookups
+    
+    The scheme, fragment, credentials, default ports, a leading "www." and tracking
+    parameters are dropped, the host is lowercased and the remaining query is sorted.
+    
+    Args:
+        url: The URL of a ToS page
+        
+    Returns:
+        (canonical_url, domain_path), where domain_path is canonical_url without the query,
+        or (None, None) if url is empty or not an http(s) URL
+    """
+    if not url:
+        return None, None
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None, None
+    if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+        return None, None
+    host = parts.hostname.lower().rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_QUERY_PARAMS and not key.startswith("utm_")
+    ))
+    domain_path = f"{host}{path}"
+    return (f"{domain_path}?{query}" if query else domain_path), domain_path
 
 def get_db_connection():
     """
@@ -36,10 +84,8 @@ def get_db_connection():
         SQLite connection object
     """
     try:
-        # Ensure database schema exists
-        if not os.path.exists(DB_PATH):
-            logger.info(f"Database file does not exist at {DB_PATH}, initializing schema")
-            initialize_database()
+        # Ensure database schema exists and is up to date
+        ensure_schema()
         
         conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row
@@ -50,81 +96,267 @@ def get_db_connection():
         logger.error(f"Failed to connect to database: {e}")
         raise
 
-def initialize_database():
+def _execute_script(conn, filename: str):
+    """
+    Run the statements of a .sql file from DB_DIR one at a time. Unlike executescript
+    this does not commit first, so the script becomes part of the caller's transaction.
+    """
+    with open(os.path.join(DB_DIR, filename), 'r') as f:
+        script = f.read()
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+def initialize_schema():
     """
-    Initialize the database schema from ddl.sql if it doesn't exist
+    Create the database schema from ddl.sql and usage.sql, upgrading tables created by an older
+    ddl.sql first. Every step is idempotent and the whole setup runs in one BEGIN IMMEDIATE
+    transaction, so processes starting together queue up on the database lock instead of racing.
     """
+    start_time = time.time()
+    logger.info(f"Setting up database schema at {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH, timeout=SCHEMA_LOCK_TIMEOUT, isolation_level=None)
     try:
-        # Create a basic connection without row factory
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Read and execute the DDL script
-        ddl_path = os.path.join(DB_DIR, "ddl.sql")
-        logger.info(f"Initializing database from {ddl_path}")
-        
-        with open(ddl_path, 'r') as f:
-            ddl_script = f.read()
-        
-        cursor.executescript(ddl_script)
-        conn.commit()
-        
-        # Also initialize languages
-        initialize_languages(conn)
-        
+        # WAL keeps readers unblocked while the writer commits; the mode is stored in the database file
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migrate_schema(conn)
+            _execute_script(conn, "ddl.sql")
+            _execute_script(conn, "usage.sql")
+            initialize_languages(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        setup_search_index(conn)
+    finally:
         conn.close()
-        logger.info("Database schema initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize database: {e}")
-        if os.path.exists(DB_PATH):
-            logger.warning(f"Removing potentially corrupted database file: {DB_PATH}")
-            os.remove(DB_PATH)
-        raise
+    logger.info(f"Database schema ready in {time.time() - start_time:.3f} seconds")
 
-def initialize_languages(conn):
+def migrate_schema(conn):
     """
-    Initialize the languages table with at least the supported languages
+    Bring tables created by an older ddl.sql up to date, before ddl.sql creates whatever is missing.
+    Runs inside initialize_schema's transaction; tables that do not exist yet are left to ddl.sql.
     """
-    try:
-        cursor = conn.cursor()
-        
-        # Add at least the basic languages we need
-        languages = ["English", "Russian", "Spanish", "French", "German"]
-        
-        for lang in languages:
+    cursor = conn.cursor()
+    # UPSERTs on yoola need content_hash to be unique; ddl.sql replaces the old plain index
+    cursor.execute("DROP INDEX IF EXISTS idx_yoola_content_hash")
+    # Summaries are tagged with the model and prompt version that produced them
+    summary_columns = {row[1] for row in cursor.execute("PRAGMA table_info(yoola_lang_summary)")}
+    if summary_columns:
+        for column in ("model", "prompt_version"):
+            if column not in summary_columns:
+                cursor.execute(f"ALTER TABLE yoola_lang_summary ADD COLUMN {column} TEXT")
+    # Canonical URL keys and a write timestamp let clients look up the latest summary for a page
+    yoola_columns = {row[1] for row in cursor.execute("PRAGMA table_info(yoola)")}
+    if yoola_columns:
+        for column, column_type in (("canonical_url", "TEXT"), ("domain_path", "TEXT"), ("updated_at", "REAL")):
+            if column not in yoola_columns:
+                cursor.execute(f"ALTER TABLE yoola ADD COLUMN {column} {column_type}")
+        # Rows stored before this migration have no timestamp; their ids keep them in insertion order
+        rows = cursor.execute("SELECT id, url FROM yoola WHERE url IS NOT NULL AND canonical_url IS NULL").fetchall()
+        cursor.executemany(
+            "UPDATE yoola SET canonical_url = ?, domain_path = ?, updated_at = COALESCE(updated_at, id) WHERE id = ?",
+            [(*canonicalize_url(url), yoola_id) for yoola_id, url in rows]
+        )
+    if summary_columns and yoola_columns:
+        merge_duplicate_documents(conn)
+    if summary_columns and "id" not in summary_columns:
+        rebuild_summary_table(conn)
+
+def merge_duplicate_documents(conn) -> int:
+    """
+    Merge yoola rows sharing a content_hash into the oldest one, so the unique index from ddl.sql
+    can be created. Racing requests could store a document twice before that index existed.
+    Summaries move to the kept row; where both rows have one in the same language, the kept
+    summary wins unless it is a legacy 'null', and the request counts are added up.
+    
+    Returns:
+        The number of yoola rows removed
+    """
+    cursor = conn.cursor()
+    duplicates = cursor.execute(
+        """
+        SELECT y.id, k.keep_id
+        FROM yoola y
+        JOIN (
+            SELECT content_hash, MIN(id) AS keep_id FROM yoola
+            WHERE content_hash IS NOT NULL
+            GROUP BY content_hash HAVING COUNT(*) > 1
+        ) k ON y.content_hash = k.content_hash AND y.id != k.keep_id
+        ORDER BY y.id
+        """
+    ).fetchall()
+    for duplicate_id, keep_id in duplicates:
+        summaries = cursor.execute(
+            "SELECT language, summary, request_num, model, prompt_version FROM yoola_lang_summary WHERE yoola_id = ?",
+            (duplicate_id,)
+        ).fetchall()
+        for language, summary, request_num, model, prompt_version in summaries:
+            kept = cursor.execute(
+                "SELECT summary FROM yoola_lang_summary WHERE yoola_id = ? AND language = ?",
+                (keep_id, language)
+            ).fetchone()
+            if kept is None:
+                cursor.execute(
+                    "UPDATE yoola_lang_summary SET yoola_id = ? WHERE yoola_id = ? AND language = ?",
+                    (keep_id, duplicate_id, language)
+                )
+                continue
+            if kept[0] == 'null' and summary != 'null':
+                cursor.execute(
+                    "UPDATE yoola_lang_summary SET summary = ?, model = ?, prompt_version = ? WHERE yoola_id = ? AND language = ?",
+                    (summary, model, prompt_version, keep_id, language)
+                )
             cursor.execute(
-                "INSERT OR IGNORE INTO languages(language) VALUES (?)",
-                (lang,)
+                "UPDATE yoola_lang_summary SET request_num = request_num + ? WHERE yoola_id = ? AND language = ?",
+                (request_num, keep_id, language)
             )
-        
+            cursor.execute("DELETE FROM yoola_lang_summary WHERE yoola_id = ? AND language = ?", (duplicate_id, language))
+        cursor.execute("DELETE FROM yoola WHERE id = ?", (duplicate_id,))
+    if duplicates:
+        logger.info(f"Merged {len(duplicates)} duplicate documents into the oldest row with the same content hash")
+    return len(duplicates)
+
+def rebuild_summary_table(conn):
+    """
+    Give yoola_lang_summary an INTEGER PRIMARY KEY. yoola_summary_fts is keyed on it, and unlike
+    the implicit rowid it is never renumbered by VACUUM. SQLite cannot add a primary key to an
+    existing table, so the rows are copied into a new one; dropping the old table also drops its
+    indexes and triggers, which ddl.sql and search.sql then create again.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE yoola_lang_summary_new (
+          id              INTEGER PRIMARY KEY,
+          yoola_id        INTEGER NOT NULL,
+          language        TEXT    NOT NULL,
+          summary         JSON    NOT NULL,
+          request_num     INTEGER NOT NULL,
+          model           TEXT,
+          prompt_version  TEXT,
+          UNIQUE (yoola_id, language),
+          FOREIGN KEY (yoola_id) REFERENCES yoola(id)
+            ON DELETE CASCADE ON UPDATE CASCADE,
+          FOREIGN KEY (language) REFERENCES languages(language)
+            ON DELETE RESTRICT ON UPDATE CASCADE
+        )
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO yoola_lang_summary_new (yoola_id, language, summary, request_num, model, prompt_version)
+        SELECT yoola_id, language, summary, request_num, model, prompt_version FROM yoola_lang_summary
+        """
+    )
+    cursor.execute("DROP TABLE yoola_lang_summary")
+    cursor.execute("ALTER TABLE yoola_lang_summary_new RENAME TO yoola_lang_summary")
+    # Its rows point at the old rowids; setup_search_index fills it again when it is missing
+    cursor.execute("DROP TABLE IF EXISTS yoola_summary_fts")
+    logger.info("Rebuilt yoola_lang_summary with a stable primary key")
+
+def setup_search_index(conn):
+    """
+    Create the full-text search tables and triggers from search.sql, filling them
+    from existing rows when they are created for the first time
+    """
+    global search_available
+    conn.execute("BEGIN IMMEDIATE")
+    is_new = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('yoola_fts', 'yoola_summary_fts')").fetchone()[0] < 2
+    try:
+        _execute_script(conn, "search.sql")
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        logger.warning(f"Full-text search is unavailable, SQLite may lack FTS5 support: {e}")
+        search_available = False
+        return
+    if is_new:
+        # Commits the transaction
+        rebuild_search_index(conn)
+    else:
         conn.commit()
-        logger.info(f"Initialized {len(languages)} basic languages in the database")
-    except Exception as e:
-        logger.error(f"Failed to initialize languages: {e}")
+    search_available = True
+
+def rebuild_search_index(conn):
+    """
+    Rebuild both full-text indexes from yoola and yoola_lang_summary
+    """
+    start_time = time.time()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO yoola_fts(yoola_fts) VALUES ('rebuild')")
+    cursor.execute("DELETE FROM yoola_summary_fts")
+    cursor.execute(
+        """
+        INSERT INTO yoola_summary_fts(rowid, summary_text, yoola_id, language)
+        SELECT s.id,
+               (SELECT group_concat(value, ' ') FROM json_tree(s.summary) WHERE type = 'text' AND key IS NOT 'language_code'),
+               s.yoola_id, s.language
+        FROM yoola_lang_summary s
+        """
+    )
+    conn.commit()
+    logger.info(f"Rebuilt full-text search index in {time.time() - start_time:.3f} seconds")
+
+def ensure_schema():
+    """
+    Run initialize_schema once per process. The server calls this at startup; get_db_connection
+    calls it as well so scripts using this module need no explicit setup.
+    Threads opening their first connection concurrently wait until the schema is ready.
+    """
+    global _schema_migrated
+    if _schema_migrated:
+        return
+    with _schema_lock:
+        if _schema_migrated:
+            return
+        initialize_schema()
+        _schema_migrated = True
+
+def initialize_languages(conn):
+    """
+    Initialize the languages table with at least the supported languages.
+    Part of initialize_schema's transaction, so it does not commit.
+    """
+    cursor = conn.cursor()
+    
+    # Add at least the basic languages we need
+    languages = ["English", "Russian", "Spanish", "French", "German"]
+    
+    for lang in languages:
+        cursor.execute(
+            "INSERT OR IGNORE INTO languages(language) VALUES (?)",
+            (lang,)
+        )
+    
+    logger.info(f"Initialized {len(languages)} basic languages in the database")
 
-def get_summary_by_content(content: str, language: str = "en") -> Optional[Dict[str, Any]]:
+def get_summary_entry(content_hash: str, language: str = "en") -> Optional[Dict[str, Any]]:
     """
-    Retrieve a summary by content and language from the SQLite database
+    Retrieve a stored summary together with the model and prompt version that produced it
     
     Args:
-        content: The text content to find a summary for
+        content_hash: Hash of the content as computed by compute_content_hash
         language: The language code (default: "en")
         
     Returns:
-        The summary data as a dict if found, None otherwise
+        A dict with keys summary, model and prompt_version if found, None otherwise.
+        model and prompt_version are None for summaries stored before versioning.
     """
     start_time = time.time()
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Generate content hash for lookup
-        content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
         logger.info(f"Looking up summary for content hash: {content_hash}, language: {language}")
         
         # Query to find the summary by content hash and language
         query = """
-        SELECT s.summary 
+        SELECT s.summary, s.model, s.prompt_version
         FROM yoola_lang_summary s
         JOIN yoola y ON s.yoola_id = y.id
         WHERE y.content_hash = ? AND s.language = ?
@@ -133,11 +365,11 @@ def get_summary_by_content(content: str, language: str = "en") -> Optional[Dict[
         result = cursor.execute(query, (content_hash, language)).fetchone()
         conn.close()
         
-        if result:
-            # Parse the JSON summary
-            summary_data = json.loads(result[0])
+        # Failed generations used to be stored as JSON null; treat them as misses
+        summary_data = json.loads(result[0]) if result else None
+        if summary_data is not None:
             logger.info(f"Found existing summary for hash '{content_hash}' in language '{language}'")
-            return summary_data
+            return {"summary": summary_data, "model": result[1], "prompt_version": result[2]}
         else:
             logger.info(f"No summary found for hash '{content_hash}' in language '{language}'")
             return None
@@ -148,102 +380,438 @@ def get_summary_by_content(content: str, language: str = "en") -> Optional[Dict[
         elapsed = time.time() - start_time
         logger.info(f"Summary lookup took {elapsed:.3f} seconds")
 
-def add_or_update_summary(content: str, summary_data: Dict[str, Any], url: str = None, language: str = "en") -> bool:
+def get_latest_summary_by_url(url: str, language: str = "en") -> Optional[Dict[str, Any]]:
     """
-    Add or update a summary in the SQLite database
+    Find the summary stored for a page, without needing its content
+    
+    The canonical URL is tried first, then the same domain and path with any query. When several
+    documents were submitted for the same page, the most requested one wins, so that a single
+    request with made-up content cannot take over the page; recency only breaks ties.
     
     Args:
-        content: The text content the summary is for
-        summary_data: The summary data to store (will be converted to JSON)
-        url: The URL where the content was found (optional)
+        url: The URL of the ToS page
         language: The language code (default: "en")
         
     Returns:
-        True if successful, False otherwise
+        A dict with keys summary, content_hash, model, prompt_version and matched_by
+        ("url" or "domain_path") if found or the database is unavailable, None otherwise
     """
-    start_time = time.time()
+    canonical_url, domain_path = canonicalize_url(url)
+    if not canonical_url:
+        return None
+    conn = None
     try:
-        logger.info(f"Adding/updating summary for content in language '{language}' with URL '{url}'")
         conn = get_db_connection()
-        cursor = conn.cursor()
+        for column, key in (("canonical_url", canonical_url), ("domain_path", domain_path)):
+            result = conn.execute(
+                f"""
+                SELECT s.summary, y.content_hash, s.model, s.prompt_version
+                FROM yoola y
+                JOIN yoola_lang_summary s ON s.yoola_id = y.id
+                WHERE y.{column} = ? AND s.language = ? AND s.summary != 'null'
+                ORDER BY s.request_num DESC, y.updated_at DESC
+                LIMIT 1
+                """,
+                (key, language)
+            ).fetchone()
+            if result:
+                logger.info(f"Found summary for URL '{url}' by {column} in language '{language}'")
+                return {
+                    "summary": json.loads(result[0]),
+                    "content_hash": result[1],
+                    "model": result[2],
+                    "prompt_version": result[3],
+                    "matched_by": "url" if column == "canonical_url" else "domain_path",
+                }
+        logger.info(f"No summary found for URL '{url}' in language '{language}'")
+        return None
+    except Exception as e:
+        logger.error(f"Error looking up summary by URL in SQLite database: {e}", exc_info=True)
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def search_documents(query: str, scope: str = "tos", language: Optional[str] = None,
+                     limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Full-text search over stored ToS text or summaries, best matches first
+    
+    Args:
+        query: An FTS5 query, e.g. 'arbitration' or '"third parties" AND sell*'
+        scope: "tos" to search the ToS text, "summaries" to search generated summaries
+        language: Only return summaries in this language (summaries scope only)
+        limit: Maximum number of results
+        offset: Number of results to skip, for pagination
         
-        # First check if the language exists in the languages table
-        lang_exists = cursor.execute(
-            "SELECT 1 FROM languages WHERE language = ?", 
-            (language,)
-        ).fetchone()
+    Returns:
+        A list of dicts with keys domain_path, content_hash, language (None for ToS results),
+        snippet and score (bm25, lower is better). Full URLs are left out, their query strings
+        may carry users' tokens or tracking ids.
         
-        # If language doesn't exist, add it
-        if not lang_exists:
-            logger.info(f"Language '{language}' not found in database, adding it")
-            cursor.execute(
-                "INSERT INTO languages(language) VALUES (?)",
-                (language,)
-            )
-            conn.commit()
+    Raises:
+        RuntimeError: If SQLite lacks FTS5 support or the database could not be searched
+        ValueError: If the query is not valid FTS5 syntax
+    """
+    ensure_schema()
+    if not search_available:
+        raise RuntimeError("Full-text search is not available on this server")
+    if scope == "tos":
+        sql = """
+        SELECT y.domain_path, y.content_hash, NULL,
+               snippet(yoola_fts, 0, '[', ']', '...', 24), bm25(yoola_fts) AS score
+        FROM yoola_fts
+        JOIN yoola y ON y.id = yoola_fts.rowid
+        WHERE yoola_fts MATCH ?
+        ORDER BY score
+        LIMIT ? OFFSET ?
+        """
+        params = (query, limit, offset)
+    elif scope == "summaries":
+        sql = f"""
+        SELECT y.domain_path, y.content_hash, f.language,
+               snippet(yoola_summary_fts, 0, '[', ']', '...', 24), bm25(yoola_summary_fts) AS score
+        FROM yoola_summary_fts f
+        JOIN yoola y ON y.id = f.yoola_id
+        WHERE yoola_summary_fts MATCH ? {"AND f.language = ?" if language else ""}
+        ORDER BY score
+        LIMIT ? OFFSET ?
+        """
+        params = (query, language, limit, offset) if language else (query, limit, offset)
+    else:
+        raise ValueError(f"Unknown search scope '{scope}'")
+    
+    start_time = time.time()
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError as e:
+        if str(e).startswith(FTS_QUERY_ERRORS):
+            raise ValueError(f"Invalid search query: {e}") from e
+        # Anything else, e.g. "database is locked", is a server problem
+        logger.error(f"Search for '{query}' failed: {e}")
+        raise RuntimeError("Full-text search is temporarily unavailable") from e
+    finally:
+        conn.close()
+    logger.info(f"Search for '{query}' in {scope} returned {len(rows)} results in {time.time() - start_time:.3f} seconds")
+    return [
+        {"domain_path": row[0], "content_hash": row[1], "language": row[2], "snippet": row[3], "score": row[4]}
+        for row in rows
+    ]
+
+def record_usage(conn, records: Iterable[Dict[str, Any]]) -> None:
+    """
+    Persist LLM usage records and add them to the daily rollup in a single transaction
+    
+    Args:
+        conn: An open SQLite connection
+        records: Dicts with keys created_at, client_address, client_id, domain, model, content_hash,
+            language, prompt_tokens, completion_tokens and cost_usd
+    """
+    records = list(records)
+    if not records:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        cursor.executemany(
+            """
+            INSERT INTO llm_usage (created_at, client_address, client_id, domain, model, content_hash, language,
+                                   prompt_tokens, completion_tokens, cost_usd)
+            VALUES (:created_at, :client_address, :client_id, :domain, :model, :content_hash, :language,
+                    :prompt_tokens, :completion_tokens, :cost_usd)
+            """,
+            records
+        )
+        cursor.executemany(
+            """
+            INSERT INTO llm_usage_rollup (day, domain, client_address, client_id, model, requests, prompt_tokens, completion_tokens, cost_usd)
+            VALUES (date(:created_at, 'unixepoch'), :domain, :client_address, :client_id, :model, 1, :prompt_tokens, :completion_tokens, :cost_usd)
+            ON CONFLICT(day, domain, client_address, client_id, model) DO UPDATE SET
+                requests = requests + 1,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                cost_usd = cost_usd + excluded.cost_usd
+            """,
+            records
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def get_usage_totals(day: str, client_address: Optional[str] = None, domain: Optional[str] = None) -> Tuple[int, float]:
+    """
+    Total tokens and estimated cost of one UTC day for a client address or a domain
+    
+    Args:
+        day: The day as YYYY-MM-DD
+        client_address: Restrict to this client address
+        domain: Restrict to this domain
         
-        # Calculate content hash in Python
-        content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
-        logger.info(f"Content hash: {content_hash}")
+    Returns:
+        (tokens, cost_usd)
+    """
+    column, value = ("client_address", client_address) if client_address is not None else ("domain", domain)
+    conn = get_db_connection()
+    try:
+        tokens, cost = conn.execute(
+            f"""
+            SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost_usd), 0)
+            FROM llm_usage_rollup WHERE day = ? AND {column} = ?
+            """,
+            (day, value)
+        ).fetchone()
+    finally:
+        conn.close()
+    return tokens, cost
+
+def get_usage_report(day: str, group_by: str = "domain", limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Largest LLM spenders of one UTC day
+    
+    Args:
+        day: The day as YYYY-MM-DD
+        group_by: "domain", "client_address", "client_id" or "model"
+        limit: Maximum number of rows
         
-        # Check if content already exists
-        yoola_id_result = cursor.execute("SELECT id FROM yoola WHERE content_hash = ?", (content_hash,)).fetchone()
+    Returns:
+        Dicts with the group key, requests, prompt_tokens, completion_tokens and cost_usd, most expensive first
+    """
+    if group_by not in ("domain", "client_address", "client_id", "model"):
+        raise ValueError(f"Cannot group usage by '{group_by}'")
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT {group_by}, SUM(requests), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost_usd) AS cost
+            FROM llm_usage_rollup WHERE day = ?
+            GROUP BY {group_by}
+            ORDER BY cost DESC, SUM(prompt_tokens + completion_tokens) DESC
+            LIMIT ?
+            """,
+            (day, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {group_by: row[0], "requests": row[1], "prompt_tokens": row[2], "completion_tokens": row[3], "cost_usd": row[4]}
+        for row in rows
+    ]
+
+def get_version_progress(model: str, prompt_version: str, top: int = 1000) -> Dict[str, Any]:
+    """
+    Report how many of the most-requested summaries were produced by the given model and prompt version
+    
+    Args:
+        model: The current model ID
+        prompt_version: The current prompt version
+        top: How many of the most-requested summaries count as hot
         
-        # If content doesn't exist, insert it into yoola table
-        if not yoola_id_result:
-            logger.info(f"Content with hash {content_hash} not found, inserting new record")
-            cursor.execute(
-                "INSERT INTO yoola (content, url, content_hash) VALUES (?, ?, ?)",
-                (content, url, content_hash)
+    Returns:
+        A dict with the number of hot summaries, how many are current and their share
+    """
+    conn = get_db_connection()
+    try:
+        total, current = conn.execute(
+            """
+            SELECT COUNT(*), COALESCE(SUM(model IS ? AND prompt_version IS ?), 0)
+            FROM (
+                SELECT model, prompt_version FROM yoola_lang_summary
+                -- Failed generations used to be stored as JSON null
+                WHERE summary != 'null'
+                ORDER BY request_num DESC
+                LIMIT ?
             )
-            yoola_id = cursor.lastrowid
-            logger.info(f"Inserted new content with ID: {yoola_id}")
-        else:
-            yoola_id = yoola_id_result[0]
-            logger.info(f"Found existing content with ID: {yoola_id}")
-            # Update URL if provided and different from current
-            if url:
-                cursor.execute("UPDATE yoola SET url = ? WHERE id = ? AND (url IS NULL OR url != ?)", 
-                              (url, yoola_id, url))
-        
-        # Check if this language version already exists
-        existing = cursor.execute(
-            "SELECT 1 FROM yoola_lang_summary WHERE yoola_id = ? AND language = ?", 
-            (yoola_id, language)
+            """,
+            (model, prompt_version, top)
         ).fetchone()
+    finally:
+        conn.close()
+    return {
+        "hot_summaries": total,
+        "on_current_version": current,
+        "share_current": current / total if total else 1.0,
+    }
+
+def reserve_regeneration_slot(interval: float) -> float:
+    """
+    Reserve the next start in the regeneration schedule shared by all workers using this database
+    
+    Args:
+        interval: Minimum time in seconds between two regeneration starts
         
-        # Convert summary_data to JSON string
-        summary_json = json.dumps(summary_data)
-        
-        # Insert or update the summary
-        if existing:
-            logger.info(f"Updating existing summary for content ID {yoola_id} in language '{language}'")
-            # Update existing summary
-            request_num_query = "SELECT request_num FROM yoola_lang_summary WHERE yoola_id = ? AND language = ?"
-            current_request_num = cursor.execute(request_num_query, (yoola_id, language)).fetchone()[0]
-            
-            cursor.execute(
-                "UPDATE yoola_lang_summary SET summary = ?, request_num = ? WHERE yoola_id = ? AND language = ?",
-                (summary_json, current_request_num + 1, yoola_id, language)
-            )
-        else:
-            logger.info(f"Creating new summary for content ID {yoola_id} in language '{language}'")
-            # Insert new summary with request_num = 1
-            cursor.execute(
-                "INSERT INTO yoola_lang_summary (yoola_id, language, summary, request_num) VALUES (?, ?, ?, 1)",
-                (yoola_id, language, summary_json)
-            )
+    Returns:
+        The number of seconds to wait until the reserved start, 0 if it may start now
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT next_start FROM regeneration_schedule WHERE id = 1").fetchone()
+        start = max(now, row[0]) if row else now
+        conn.execute(
+            """
+            INSERT INTO regeneration_schedule (id, next_start) VALUES (1, ?)
+            ON CONFLICT(id) DO UPDATE SET next_start = excluded.next_start
+            """,
+            (start + interval,)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return start - now
+
+def claim_regeneration(content_hash: str, language: str, ttl: float) -> bool:
+    """
+    Claim a summary for regeneration, unless another worker claimed it less than ttl seconds ago.
+    Claims are not released: they expire, so a regeneration still in the writer's queue is not repeated.
+    
+    Args:
+        content_hash: Hash of the content as computed by compute_content_hash
+        language: The summary language
+        ttl: How long the claim holds, in seconds
         
+    Returns:
+        True if this worker should regenerate the summary
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("DELETE FROM regeneration_claims WHERE claimed_until <= ?", (now,))
+        cursor.execute(
+            "INSERT OR IGNORE INTO regeneration_claims (content_hash, language, claimed_until) VALUES (?, ?, ?)",
+            (content_hash, language, now + ttl)
+        )
+        claimed = cursor.rowcount == 1
         conn.commit()
-        logger.info(f"Successfully saved summary to database")
+    finally:
         conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Error adding/updating summary in SQLite database: {e}", exc_info=True)
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            conn.close()
-        return False
+    return claimed
+
+def get_hot_summaries(limit: int) -> List[Dict[str, Any]]:
+    """
+    The most-requested summaries, most requested first
+    
+    Args:
+        limit: Maximum number of summaries returned
+        
+    Returns:
+        A list of dicts with keys content_hash, language, summary, model and prompt_version
+    """
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(
+            """
+            SELECT y.content_hash, s.language, s.summary, s.model, s.prompt_version
+            FROM yoola_lang_summary s
+            JOIN yoola y ON s.yoola_id = y.id
+            -- Failed generations used to be stored as JSON null
+            WHERE s.summary != 'null'
+            ORDER BY s.request_num DESC
+            LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
     finally:
-        elapsed = time.time() - start_time
-        logger.info(f"Summary save operation took {elapsed:.3f} seconds")
+        conn.close()
+    return [
+        {
+            "content_hash": row["content_hash"],
+            "language": row["language"],
+            "summary": json.loads(row["summary"]),
+            "model": row["model"],
+            "prompt_version": row["prompt_version"],
+        }
+        for row in rows
+    ]
+
+def upsert_summaries(conn, items: Iterable[Dict[str, Any]]) -> int:
+    """
+    Persist a batch of summaries inside a single transaction using UPSERT statements.
+    The caller owns the connection; this function commits on success and rolls back on error.
+    
+    Args:
+        conn: An open SQLite connection
+        items: Dicts with keys content, content_hash, url, language, summary_data, model and
+            prompt_version, plus an optional request_count added to request_num (default 1)
+        
+    Returns:
+        The number of summaries written
+    """
+    items = list(items)
+    if not items:
+        return 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO languages(language) VALUES (?)",
+            [(language,) for language in {item["language"] for item in items}]
+        )
+        now = time.time()
+        cursor.executemany(
+            """
+            INSERT INTO yoola (content, url, content_hash, canonical_url, domain_path, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(content_hash) DO UPDATE SET
+                url = COALESCE(excluded.url, yoola.url),
+                canonical_url = COALESCE(excluded.canonical_url, yoola.canonical_url),
+                domain_path = COALESCE(excluded.domain_path, yoola.domain_path),
+                updated_at = CASE WHEN ? > 0 THEN excluded.updated_at ELSE yoola.updated_at END
+            """,
+            [
+                # Regenerations (request_count 0) leave updated_at alone, it tracks when the page was last submitted
+                (item["content"], item.get("url"), item["content_hash"], *canonicalize_url(item.get("url")), now,
+                 item.get("request_count", 1))
+                for item in items
+            ]
+        )
+        cursor.executemany(
+            """
+            INSERT INTO yoola_lang_summary (yoola_id, language, summary, request_num, model, prompt_version)
+            VALUES ((SELECT id FROM yoola WHERE content_hash = ?), ?, ?, ?, ?, ?)
+            ON CONFLICT(yoola_id, language) DO UPDATE SET
+                summary = excluded.summary,
+                model = excluded.model,
+                prompt_version = excluded.prompt_version,
+                request_num = yoola_lang_summary.request_num + excluded.request_num
+            """,
+            [
+                (item["content_hash"], item["language"], json.dumps(item["summary_data"]),
+                 item.get("request_count", 1), item.get("model"), item.get("prompt_version"))
+                for item in items
+            ]
+        )
+        conn.commit()
+        return len(items)
+    except Exception:
+        conn.rollback()
+        raise
+
+def record_hits(conn, hits: Dict[Tuple[str, str], int]) -> None:
+    """
+    Add cache hits to request_num in a single transaction
+    
+    Args:
+        conn: An open SQLite connection
+        hits: Number of hits keyed by (content_hash, language)
+    """
+    if not hits:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        cursor.executemany(
+            """
+            UPDATE yoola_lang_summary SET request_num = request_num + ?
+            WHERE yoola_id = (SELECT id FROM yoola WHERE content_hash = ?) AND language = ?
+            """,
+            [(count, content_hash, language) for (content_hash, language), count in hits.items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -1,24 +1,31 @@
-PRAGMA foreign_keys = ON;
+-- Every statement is idempotent; db.initialize_schema runs this script on each start
+-- inside one transaction, after migrate_schema upgraded tables from older versions.
 
 -- tables
-CREATE TABLE yoola (
+CREATE TABLE IF NOT EXISTS yoola (
   id            INTEGER PRIMARY KEY,
   content       TEXT    NOT NULL,
   url           TEXT,
-  content_hash  TEXT
+  content_hash  TEXT,
+  canonical_url TEXT,
+  domain_path   TEXT,
+  updated_at    REAL
 );
 
-CREATE TABLE languages (
+CREATE TABLE IF NOT EXISTS languages (
   language  TEXT PRIMARY KEY,
   picture   BLOB
 );
 
-CREATE TABLE yoola_lang_summary (
-  yoola_id     INTEGER NOT NULL,
-  language     TEXT    NOT NULL,
-  summary      JSON    NOT NULL,
-  request_num  INTEGER NOT NULL,
-  PRIMARY KEY (yoola_id, language),
+CREATE TABLE IF NOT EXISTS yoola_lang_summary (
+  id              INTEGER PRIMARY KEY,
+  yoola_id        INTEGER NOT NULL,
+  language        TEXT    NOT NULL,
+  summary         JSON    NOT NULL,
+  request_num     INTEGER NOT NULL,
+  model           TEXT,
+  prompt_version  TEXT,
+  UNIQUE (yoola_id, language),
   FOREIGN KEY (yoola_id) REFERENCES yoola(id)
     ON DELETE CASCADE ON UPDATE CASCADE,
   FOREIGN KEY (language) REFERENCES languages(language)
@@ -29,17 +36,33 @@ CREATE TABLE yoola_lang_summary (
 -- We'll compute the hash in Python code instead
 
 -- indexes on yoola
-CREATE INDEX idx_yoola_id           ON yoola(id);
-CREATE INDEX idx_yoola_content      ON yoola(content);
-CREATE INDEX idx_yoola_url          ON yoola(url);
-CREATE INDEX idx_yoola_content_hash ON yoola(content_hash);
+CREATE INDEX IF NOT EXISTS idx_yoola_id           ON yoola(id);
+CREATE INDEX IF NOT EXISTS idx_yoola_content      ON yoola(content);
+CREATE INDEX IF NOT EXISTS idx_yoola_url          ON yoola(url);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_yoola_content_hash_unique ON yoola(content_hash);
+CREATE INDEX IF NOT EXISTS idx_yoola_canonical_url ON yoola(canonical_url, updated_at);
+CREATE INDEX IF NOT EXISTS idx_yoola_domain_path   ON yoola(domain_path, updated_at);
 
 -- indexes on languages
-CREATE INDEX idx_languages_language ON languages(language);
-CREATE INDEX idx_languages_picture  ON languages(picture);
+CREATE INDEX IF NOT EXISTS idx_languages_language ON languages(language);
+CREATE INDEX IF NOT EXISTS idx_languages_picture  ON languages(picture);
 
 -- indexes on yoola_lang_summary
-CREATE INDEX idx_yls_yoola_id     ON yoola_lang_summary(yoola_id);
-CREATE INDEX idx_yls_language     ON yoola_lang_summary(language);
-CREATE INDEX idx_yls_summary      ON yoola_lang_summary(summary);
-CREATE INDEX idx_yls_request_num  ON yoola_lang_summary(request_num);
+CREATE INDEX IF NOT EXISTS idx_yls_yoola_id     ON yoola_lang_summary(yoola_id);
+CREATE INDEX IF NOT EXISTS idx_yls_language     ON yoola_lang_summary(language);
+CREATE INDEX IF NOT EXISTS idx_yls_request_num  ON yoola_lang_summary(request_num);
+
+-- background regeneration, coordinated across every worker using this database
+-- next allowed start of a regeneration (a single row), so the configured rate is global
+CREATE TABLE IF NOT EXISTS regeneration_schedule (
+  id          INTEGER PRIMARY KEY CHECK (id = 1),
+  next_start  REAL    NOT NULL
+);
+
+-- documents being regenerated, so only one worker calls the LLM for each
+CREATE TABLE IF NOT EXISTS regeneration_claims (
+  content_hash   TEXT  NOT NULL,
+  language       TEXT  NOT NULL,
+  claimed_until  REAL  NOT NULL,
+  PRIMARY KEY (content_hash, language)
+) WITHOUT ROWID;
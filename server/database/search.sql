@@ -0,0 +1,51 @@
+-- Full-text search over stored ToS text and summaries (requires SQLite built with FTS5).
+-- Every statement is idempotent; db.initialize_schema runs this script on each start.
+
+-- ToS text, indexed straight from yoola.content without storing a second copy
+CREATE VIRTUAL TABLE IF NOT EXISTS yoola_fts USING fts5(
+  content,
+  content = 'yoola',
+  content_rowid = 'id',
+  tokenize = 'porter unicode61 remove_diacritics 2'
+);
+
+-- Summary text, one row per yoola_lang_summary row (rowid = yoola_lang_summary.id).
+-- Only the JSON string values are indexed, not the keys.
+CREATE VIRTUAL TABLE IF NOT EXISTS yoola_summary_fts USING fts5(
+  summary_text,
+  yoola_id UNINDEXED,
+  language UNINDEXED,
+  tokenize = 'porter unicode61 remove_diacritics 2'
+);
+
+-- triggers keeping yoola_fts in sync with yoola
+CREATE TRIGGER IF NOT EXISTS yoola_fts_insert AFTER INSERT ON yoola BEGIN
+  INSERT INTO yoola_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS yoola_fts_delete AFTER DELETE ON yoola BEGIN
+  INSERT INTO yoola_fts(yoola_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS yoola_fts_update AFTER UPDATE OF content ON yoola BEGIN
+  INSERT INTO yoola_fts(yoola_fts, rowid, content) VALUES ('delete', old.id, old.content);
+  INSERT INTO yoola_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+-- triggers keeping yoola_summary_fts in sync with yoola_lang_summary
+CREATE TRIGGER IF NOT EXISTS yoola_summary_fts_insert AFTER INSERT ON yoola_lang_summary BEGIN
+  INSERT INTO yoola_summary_fts(rowid, summary_text, yoola_id, language)
+  SELECT new.id, group_concat(value, ' '), new.yoola_id, new.language
+  FROM json_tree(new.summary) WHERE type = 'text' AND key IS NOT 'language_code';
+END;
+
+CREATE TRIGGER IF NOT EXISTS yoola_summary_fts_delete AFTER DELETE ON yoola_lang_summary BEGIN
+  DELETE FROM yoola_summary_fts WHERE rowid = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS yoola_summary_fts_update AFTER UPDATE OF summary ON yoola_lang_summary BEGIN
+  DELETE FROM yoola_summary_fts WHERE rowid = old.id;
+  INSERT INTO yoola_summary_fts(rowid, summary_text, yoola_id, language)
+  SELECT new.id, group_concat(value, ' '), new.yoola_id, new.language
+  FROM json_tree(new.summary) WHERE type = 'text' AND key IS NOT 'language_code';
+END;
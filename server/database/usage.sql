@@ -0,0 +1,36 @@
+-- LLM token usage and estimated cost. Every statement is idempotent;
+-- db.initialize_schema runs this script on each start.
+
+-- one row per OpenRouter response
+CREATE TABLE IF NOT EXISTS llm_usage (
+  id                 INTEGER PRIMARY KEY,
+  created_at         REAL    NOT NULL,
+  client_address     TEXT    NOT NULL,
+  client_id          TEXT    NOT NULL,
+  domain             TEXT    NOT NULL,
+  model              TEXT    NOT NULL,
+  content_hash       TEXT,
+  language           TEXT,
+  prompt_tokens      INTEGER NOT NULL,
+  completion_tokens  INTEGER NOT NULL,
+  cost_usd           REAL    NOT NULL
+);
+
+-- daily totals per domain, client and model. Budgets are kept per client_address,
+-- the caller's network address; client_id is what the caller calls itself
+-- (X-Yoola-Client) and only breaks an address's usage down further.
+CREATE TABLE IF NOT EXISTS llm_usage_rollup (
+  day                TEXT    NOT NULL,
+  domain             TEXT    NOT NULL,
+  client_address     TEXT    NOT NULL,
+  client_id          TEXT    NOT NULL,
+  model              TEXT    NOT NULL,
+  requests           INTEGER NOT NULL,
+  prompt_tokens      INTEGER NOT NULL,
+  completion_tokens  INTEGER NOT NULL,
+  cost_usd           REAL    NOT NULL,
+  PRIMARY KEY (day, domain, client_address, client_id, model)
+) WITHOUT ROWID;
+
+-- indexes on llm_usage_rollup (the primary key already covers day + domain)
+CREATE INDEX IF NOT EXISTS idx_llm_usage_rollup_address ON llm_usage_rollup(day, client_address);
@@ -0,0 +1,244 @@
+"""
+Write-behind persistence for Yoola
+Newly generated summaries are queued here so the API can answer the client immediately,
+and a dedicated writer thread persists them in batched transactions (group commit)
+"""
+import os
+import queue
+import sqlite3
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+from database.db import get_db_connection, upsert_summaries, record_hits, record_usage
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of summaries persisted in one transaction
+WRITE_BATCH_SIZE = int(os.getenv("YOOLA_WRITE_BATCH_SIZE", "64"))
+# How long the writer waits for more work before committing a partial batch
+WRITE_FLUSH_INTERVAL = float(os.getenv("YOOLA_WRITE_FLUSH_MS", "50")) / 1000
+# Cache hits and LLM usage records are buffered in memory and persisted at most this often
+HIT_FLUSH_INTERVAL = float(os.getenv("YOOLA_HIT_FLUSH_SECONDS", "5"))
+# How long stop() waits for the writer to persist what is queued, e.g. while the database stays locked
+WRITE_STOP_TIMEOUT = float(os.getenv("YOOLA_WRITE_STOP_SECONDS", "30"))
+# Longest pause between two attempts to write while the database is locked
+WRITE_RETRY_MAX_DELAY = 5.0
+
+_STOP = object()
+
+def _is_transient(error: Exception) -> bool:
+    """Lock contention clears up by itself; any other error would fail the same way again"""
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+def _retry_while_locked(description: str, write):
+    """Call write until it succeeds, backing off while the database is locked; other errors are raised"""
+    delay = 0.1
+    while True:
+        try:
+            return write()
+        except Exception as e:
+            if not _is_transient(e):
+                raise
+            logger.warning(f"{description} failed, retrying in {delay:.1f} seconds: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+
+class SummaryWriter:
+    """
+    Queue of pending summaries drained by a single background writer thread
+    """
+
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        # Summaries that are queued but not yet committed, keyed by (content_hash, language),
+        # so that a repeated request does not miss the cache while its write is in flight
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._pending_lock = threading.Lock()
+        self._hits = Counter()
+        self._usage = []
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the writer thread if it is not already running"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="yoola-summary-writer", daemon=True)
+        self._thread.start()
+        logger.info(f"Summary writer started (batch size {self.batch_size}, flush interval {self.flush_interval:.3f}s)")
+
+    def stop(self, timeout: Optional[float] = WRITE_STOP_TIMEOUT):
+        """Persist everything still queued and stop the writer thread"""
+        if not self._thread:
+            return
+        logger.info(f"Stopping summary writer, flushing {self.depth()} pending summaries")
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Summary writer did not stop within {timeout} seconds, {self.depth()} summaries not persisted")
+        else:
+            self._thread = None
+
+    def flush(self):
+        """Block until every summary queued so far has been persisted"""
+        self._queue.join()
+
+    def depth(self) -> int:
+        """Number of summaries waiting to be persisted"""
+        with self._pending_lock:
+            return len(self._pending)
+
+    def enqueue(self, content: str, content_hash: str, summary_data: Dict[str, Any], url: str = None, language: str = "en",
+                model: str = None, prompt_version: str = None, request_count: int = 1):
+        """
+        Queue a summary for persistence and return immediately
+
+        Args:
+            content: The text content the summary is for
+            content_hash: Hash of content as computed by compute_content_hash
+            summary_data: The summary data to store
+            url: The URL where the content was found (optional)
+            language: The language code (default: "en")
+            model: The model that produced the summary
+            prompt_version: The prompt version that produced the summary
+            request_count: How much to add to request_num (0 for background regeneration)
+        """
+        item = {
+            "content": content,
+            "content_hash": content_hash,
+            "url": url,
+            "language": language,
+            "summary_data": summary_data,
+            "model": model,
+            "prompt_version": prompt_version,
+            "request_count": request_count,
+        }
+        with self._pending_lock:
+            self._pending[(content_hash, language)] = item
+        if not self._thread:
+            logger.warning("Summary writer is not running, the summary will be persisted once it starts")
+        self._queue.put(item)
+
+    def record_hit(self, content_hash: str, language: str):
+        """Count a cache hit; hits are added to request_num in the background"""
+        with self._pending_lock:
+            self._hits[(content_hash, language)] += 1
+
+    def record_usage(self, record: Dict[str, Any]):
+        """Buffer an LLM usage record (see db.record_usage) for persistence in the background"""
+        with self._pending_lock:
+            self._usage.append(record)
+
+    def pending_usage(self) -> List[Dict[str, Any]]:
+        """LLM usage records that are not persisted yet"""
+        with self._pending_lock:
+            return list(self._usage)
+
+    def get_pending(self, content_hash: str, language: str) -> Optional[Dict[str, Any]]:
+        """Return a summary that is queued but not yet persisted, if any"""
+        with self._pending_lock:
+            item = self._pending.get((content_hash, language))
+        return item["summary_data"] if item else None
+
+    def _next_batch(self):
+        """Wait for the first item, then gather more until the batch is full or the flush interval passes"""
+        try:
+            batch = [self._queue.get(timeout=HIT_FLUSH_INTERVAL)]
+        except queue.Empty:
+            return []
+        if batch[0] is _STOP:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is _STOP:
+                break
+        return batch
+
+    def _write(self, conn, items):
+        """
+        Persist items in one transaction, falling back to one transaction per item on failure.
+        While the database is locked the write is retried, so paid-for summaries are not lost;
+        only items failing with any other error are dropped.
+        """
+        start_time = time.time()
+        try:
+            _retry_while_locked(f"Batch write of {len(items)} summaries", lambda: upsert_summaries(conn, items))
+            logger.info(f"Persisted {len(items)} summaries in {time.time() - start_time:.3f} seconds")
+            return
+        except Exception as e:
+            logger.error(f"Batch write of {len(items)} summaries failed: {e}", exc_info=True)
+        for item in items:
+            try:
+                _retry_while_locked(f"Write of summary for hash '{item['content_hash']}'", lambda: upsert_summaries(conn, [item]))
+            except Exception as item_error:
+                logger.error(f"Dropping summary for hash '{item['content_hash']}' in language '{item['language']}': {item_error}")
+
+    def _write_counters(self, conn):
+        """Persist buffered hits and usage; they leave the buffers once committed or failed for good"""
+        with self._pending_lock:
+            hits = Counter(self._hits)
+            usage = list(self._usage)
+        try:
+            _retry_while_locked(f"Recording {sum(hits.values())} cache hits", lambda: record_hits(conn, hits))
+        except Exception as e:
+            logger.error(f"Dropping {sum(hits.values())} cache hits: {e}", exc_info=True)
+        try:
+            _retry_while_locked(f"Recording {len(usage)} LLM usage records", lambda: record_usage(conn, usage))
+        except Exception as e:
+            logger.error(f"Dropping {len(usage)} LLM usage records: {e}", exc_info=True)
+        with self._pending_lock:
+            # Only what was written leaves the buffers; anything recorded meanwhile stays
+            self._hits -= hits
+            del self._usage[:len(usage)]
+
+    def _connect(self):
+        """Open the writer's connection, retrying so a transient failure cannot strand the queue"""
+        while True:
+            try:
+                return get_db_connection()
+            except Exception as e:
+                logger.error(f"Summary writer could not open the database, retrying: {e}")
+                time.sleep(1)
+
+    def _run(self):
+        conn = self._connect()
+        # initialize_schema switched the database to WAL, where NORMAL syncs once per checkpoint
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        next_hit_flush = time.monotonic() + HIT_FLUSH_INTERVAL
+        try:
+            while True:
+                batch = self._next_batch()
+                stopping = bool(batch) and batch[-1] is _STOP
+                items = [item for item in batch if item is not _STOP]
+                if items:
+                    self._write(conn, items)
+                    with self._pending_lock:
+                        for item in items:
+                            key = (item["content_hash"], item["language"])
+                            # A newer summary for the same key may have been queued meanwhile
+                            if self._pending.get(key) is item:
+                                del self._pending[key]
+                if not batch or stopping or time.monotonic() >= next_hit_flush:
+                    self._write_counters(conn)
+                    next_hit_flush = time.monotonic() + HIT_FLUSH_INTERVAL
+                for _ in batch:
+                    self._queue.task_done()
+                if stopping:
+                    break
+        finally:
+            conn.close()
+            logger.info("Summary writer stopped")
+
+summary_writer = SummaryWriter()
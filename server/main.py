@@ -1,20 +1,235 @@
-from openrouter_api import summarize_terms
-from database.db import get_summary_by_content, add_or_update_summary
-from fastapi import FastAPI
+import os
+import math
+import logging
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import Optional
+from dotenv import load_dotenv
+
+# Settings are read from the environment when the modules below are imported, so .env comes first
+load_dotenv()
+
+from openrouter_api import summarize_terms, SummarizationError, OVERSIZED, UPSTREAM_UNAVAILABLE, TIMED_OUT, INVALID_OUTPUT, DEFAULT_MODEL, PROMPT_VERSION
+from database.db import ensure_schema, get_summary_entry, get_latest_summary_by_url, get_version_progress, get_usage_report, search_documents, compute_content_hash
+from database.writer import summary_writer
+from cache import negative_cache, summary_cache
+from regenerator import summary_regenerator
+from profiler import profiler, profiled, profile_requested
+from usage import usage_tracker, usage_domain, estimate_usage, BudgetExceeded
+from warmup import cache_warmer
+from fastapi import FastAPI, HTTPException, Header, Request, Response, Depends, Query
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
-app = FastAPI()
+# HTTP status returned to the client for each summarization failure reason
+FAILURE_STATUS = {
+    OVERSIZED: 413,
+    UPSTREAM_UNAVAILABLE: 503,
+    TIMED_OUT: 504,
+    INVALID_OUTPUT: 502,
+}
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    # Create or upgrade the schema before serving, instead of on the first request
+    ensure_schema()
+    summary_writer.start()
+    summary_regenerator.start()
+    # Requests are served while the cache warms up; /ready reports when it is done
+    cache_warmer.start()
+    yield
+    summary_regenerator.stop()
+    # Make sure summaries handed to clients are on disk before the process exits
+    summary_writer.stop()
+    # Leave the latest request counts behind for the instances replacing this one
+    cache_warmer.save_snapshot()
+
+app = FastAPI(lifespan=lifespan)
+
+def summary_failure(reason: str, retry_after: float, message: str = None) -> HTTPException:
+    return HTTPException(
+        status_code=FAILURE_STATUS.get(reason, 502),
+        detail={"reason": reason, "message": message or "Summary is temporarily unavailable"},
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+def is_admin(token: Optional[str]) -> bool:
+    """Admin features are only enabled when YOOLA_ADMIN_TOKEN is set, and require it as a header"""
+    admin_token = os.getenv("YOOLA_ADMIN_TOKEN")
+    return bool(admin_token) and token == admin_token
+
+def client_address_for(request: Request) -> str:
+    """Budgets are kept per address, which unlike X-Yoola-Client a caller cannot simply change"""
+    return request.client.host if request.client else "unknown"
+
+def client_id_for(request: Request) -> str:
+    """The extension identifies itself with X-Yoola-Client; other callers are told apart by address"""
+    client_id = (request.headers.get("X-Yoola-Client") or "").strip()[:64]
+    return client_id or client_address_for(request)
+
+def require_admin(x_yoola_admin_token: Optional[str] = Header(None)):
+    if not is_admin(x_yoola_admin_token):
+        raise HTTPException(status_code=403, detail="Admin access denied")
+
+@app.middleware("http")
+async def select_requests_for_profiling(request: Request, call_next):
+    # A single request can be profiled on demand by an admin with the X-Yoola-Profile header
+    requested = request.headers.get("X-Yoola-Profile") == "1" and is_admin(request.headers.get("X-Yoola-Admin-Token"))
+    selected = profiler.should_profile(requested)
+    token = profile_requested.set(selected)
+    try:
+        response = await call_next(request)
+    finally:
+        profile_requested.reset(token)
+    if selected:
+        response.headers["X-Yoola-Profiled"] = "1"
+    return response
 
 @app.get("/test")
 def test():
     return "test"
 
+@app.get("/ready")
+def ready(response: Response):
+    """Readiness probe: 503 until the summary cache is warmed up, so load balancers hold traffic back"""
+    status = cache_warmer.status()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "write_queue_depth": summary_writer.depth(),
+        "summary_cache": summary_cache.stats(),
+        "negative_cache": negative_cache.stats(),
+        "regeneration_queue_depth": summary_regenerator.depth(),
+        "profiler": profiler.stats(),
+    }
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def download_profile(reset: bool = False):
+    # Folded stacks ("frame;frame;frame count" per line) for flamegraph.pl or speedscope
+    folded = profiler.folded()
+    if reset:
+        profiler.reset()
+    return PlainTextResponse(folded, headers={"Content-Disposition": 'attachment; filename="yoola-profile.folded"'})
+
+@app.delete("/admin/profile", dependencies=[Depends(require_admin)])
+def reset_profile():
+    profiler.reset()
+    return {"reset": True}
+
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+def usage_report(day: Optional[str] = None, group_by: str = Query("domain", pattern="^(domain|client_address|client_id|model)$"),
+                 limit: int = Query(50, ge=1, le=1000)):
+    day = day or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    return {"day": day, "group_by": group_by, "rows": get_usage_report(day=day, group_by=group_by, limit=limit)}
+
+@app.get("/admin/upgrade_progress", dependencies=[Depends(require_admin)])
+def upgrade_progress(top: int = Query(1000, ge=1, le=100000)):
+    progress = get_version_progress(model=DEFAULT_MODEL, prompt_version=PROMPT_VERSION, top=top)
+    progress["current_version"] = {"model": DEFAULT_MODEL, "prompt_version": PROMPT_VERSION}
+    progress["regeneration_queue_depth"] = summary_regenerator.depth()
+    return progress
+
+@app.get("/lookup")
+@profiled
+def lookup(url: str, language: str):
+    """Known summary for a page, answered before the extension extracts its content"""
+    entry = get_latest_summary_by_url(url=url, language=language)
+    if not entry:
+        raise HTTPException(status_code=404, detail="No summary known for this URL")
+    # The extension compares content_hash with X-Yoola-Content-Hash from /get_summary to detect changes
+    return {
+        "summary": entry["summary"],
+        "content_hash": entry["content_hash"],
+        "matched_by": entry["matched_by"],
+        "stale": (entry["model"], entry["prompt_version"]) != (DEFAULT_MODEL, PROMPT_VERSION),
+    }
+
+@app.get("/search", dependencies=[Depends(require_admin)])
+@profiled
+def search(q: str = Query(..., min_length=1), scope: str = Query("tos", pattern="^(tos|summaries)$"),
+           language: Optional[str] = None, page: int = Query(1, ge=1), page_size: int = Query(20, ge=1, le=100)):
+    try:
+        # Fetch one extra row to tell whether another page exists without counting every match
+        results = search_documents(query=q, scope=scope, language=language, limit=page_size + 1, offset=(page - 1) * page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {
+        "query": q,
+        "scope": scope,
+        "page": page,
+        "page_size": page_size,
+        "has_more": len(results) > page_size,
+        "results": results[:page_size],
+    }
+
 @app.get("/get_summary")
-def get_summary(content: str, domain: str, url: str, language: str):
-    ans = get_summary_by_content(content=content, language=language)
+@profiled
+def get_summary(content: str, domain: str, url: str, language: str, request: Request, response: Response):
+    content_hash = compute_content_hash(content)
+    response.headers["X-Yoola-Content-Hash"] = content_hash
+    key = (content_hash, language)
+    ans = summary_writer.get_pending(content_hash, language)
     if ans == None:
-        ans = summarize_terms(content=content, domain=domain, url=url, language = language)
-        add_or_update_summary(content=content, summary_data=ans, url=url, language=language)
+        entry = summary_cache.get(key)
+        if entry is None:
+            entry = get_summary_entry(content_hash=content_hash, language=language)
+            if entry:
+                summary_cache.put(key, entry)
+        if entry:
+            ans = entry["summary"]
+            if (entry["model"], entry["prompt_version"]) != (DEFAULT_MODEL, PROMPT_VERSION):
+                # Serve the outdated summary now and refresh it in the background
+                response.headers["X-Yoola-Stale"] = "1"
+                summary_regenerator.schedule(content=content, content_hash=content_hash, domain=domain, url=url, language=language)
+    if ans != None:
+        summary_writer.record_hit(content_hash, language)
+        return ans
+
+    backoff = negative_cache.get(key)
+    if backoff:
+        raise summary_failure(*backoff)
+    # Budgets only apply to new LLM calls; cache hits above are never restricted
+    client_address = client_address_for(request)
+    client_id = client_id_for(request)
+    budget_domain = usage_domain(url)
+    try:
+        # Counts the call at its estimated usage until it reports the real one, so concurrent requests cannot overspend
+        reservation = usage_tracker.reserve(client_address=client_address, domain=budget_domain,
+                                            model=DEFAULT_MODEL, usage=estimate_usage(content))
+    except BudgetExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"reason": e.reason, "message": str(e)},
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    on_usage = lambda model, usage: usage_tracker.record(client_address=client_address, client_id=client_id, domain=budget_domain,
+                                                         model=model, usage=usage, content_hash=content_hash, language=language,
+                                                         reservation=reservation)
+    try:
+        ans = summarize_terms(content=content, domain=domain, url=url, language = language, on_usage=on_usage)
+    except SummarizationError as e:
+        retry_after = negative_cache.record_failure(key, e.reason)
+        raise summary_failure(e.reason, retry_after, str(e))
+    finally:
+        usage_tracker.release(reservation)
+    negative_cache.record_success(key)
+    summary_writer.enqueue(content=content, content_hash=content_hash, summary_data=ans, url=url, language=language,
+                           model=DEFAULT_MODEL, prompt_version=PROMPT_VERSION)
+    summary_cache.put(key, {"summary": ans, "model": DEFAULT_MODEL, "prompt_version": PROMPT_VERSION})
     return ans
 
 if __name__ == '__main__':
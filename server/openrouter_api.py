@@ -6,29 +6,44 @@ import os
 import requests
 import json
 import logging
-from typing import Dict, Any, List, Optional
-from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Callable
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
-# Get API key from environment
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 BASE_URL = "https://openrouter.ai/api/v1"
 MAX_RETRIES = 1 # Total attempts = 1 (initial) + MAX_RETRIES (so 2 attempts total)
+# Model used for new summaries; stored summaries from any other model are regenerated in the background
+DEFAULT_MODEL = os.getenv("YOOLA_MODEL", "meta-llama/llama-4-maverick")
+# Bump whenever the prompt in summarize_terms changes in a way that should refresh stored summaries
+PROMPT_VERSION = "1"
+# Content longer than this is refused outright instead of being truncated for the model
+MAX_CONTENT_CHARS = int(os.getenv("YOOLA_MAX_CONTENT_CHARS", "200000"))
+
+# Reasons a summarization attempt can fail, used by callers to decide how long to back off
+OVERSIZED = "oversized"
+UPSTREAM_UNAVAILABLE = "upstream_unavailable"
+TIMED_OUT = "timed_out"
+INVALID_OUTPUT = "invalid_output"
+
+class SummarizationError(Exception):
+    """Raised when a summary could not be produced, with the reason it failed"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+def get_api_key() -> Optional[str]:
+    """OpenRouter API key, read when needed so that importing this module has no side effects"""
+    return os.getenv("OPENROUTER_API_KEY")
 
 def get_headers() -> Dict[str, str]:
     """Get headers for API requests"""
-    if not OPENROUTER_API_KEY:
+    if not get_api_key():
         # Log warning but allow function to proceed; error will be caught by summarize_terms
         logger.warning("OpenRouter API key not found. Set OPENROUTER_API_KEY in .env file.")
     
     return {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Authorization": f"Bearer {get_api_key()}",
         "Content-Type": "application/json",
         "HTTP-Referer": os.getenv("YOOLA_REFERER_URL", "https://yoola.example.com"), # Site URL sending request
         "X-Title": os.getenv("YOOLA_APP_NAME", "Yoola ToS Summarizer") # Your app's name
@@ -78,7 +93,8 @@ def _is_valid_summary_format(summary_data: Any, requested_language: str) -> bool
     return True
 
 
-def summarize_terms(content: str, domain: str, url: str, language: str = "en", model: str = "meta-llama/llama-4-maverick") -> Optional[Dict[str, Any]]:
+def summarize_terms(content: str, domain: str, url: str, language: str = "en", model: str = DEFAULT_MODEL,
+                    on_usage: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
     """
     Summarize terms of service using OpenRouter API.
     Attempts to generate and validate the summary, with one retry on failure.
@@ -89,13 +105,23 @@ def summarize_terms(content: str, domain: str, url: str, language: str = "en", m
         url: The URL of the terms page.
         language: The language code for the summary (default: "en").
         model: Model ID to use.
+        on_usage: Called with the model and OpenRouter's "usage" block for every response
+            received, including attempts whose output is later rejected.
     
     Returns:
-        A dictionary containing the structured summary data if successful, None otherwise.
+        A dictionary containing the structured summary data.
+    
+    Raises:
+        SummarizationError: If no valid summary could be produced. Its reason is one of
+            OVERSIZED, UPSTREAM_UNAVAILABLE, TIMED_OUT or INVALID_OUTPUT.
     """
-    if not OPENROUTER_API_KEY:
+    if not get_api_key():
         logger.error("OpenRouter API key is required but not found. Cannot proceed with summarization.")
-        return None 
+        raise SummarizationError(UPSTREAM_UNAVAILABLE, "Summarization service is not configured")
+    
+    if len(content) > MAX_CONTENT_CHARS:
+        logger.error(f"Content of {len(content)} characters exceeds the {MAX_CONTENT_CHARS} character limit")
+        raise SummarizationError(OVERSIZED, f"Content exceeds {MAX_CONTENT_CHARS} characters")
     
     # Truncate content if too large. Llama 3 8B has 8k context.
     # A character is roughly 0.25-1 token. Aim for ~6000 tokens for content.
@@ -160,7 +186,8 @@ All string values within "structured_summary" (key_points, summaries, alerts) MU
                     ],
                     "response_format": {"type": "json_object"},
                     "temperature": 0.2, # Lower temperature for more deterministic and precise output
-                    "max_tokens": 2500 # Max tokens for the summary itself
+                    "max_tokens": 2500, # Max tokens for the summary itself
+                    "usage": {"include": True} # Ask OpenRouter to report the cost of the call
                 },
                 timeout=90 # Increased timeout for potentially long ToS processing by LLM
             )
@@ -175,7 +202,14 @@ All string values within "structured_summary" (key_points, summaries, alerts) MU
                 if attempt < MAX_RETRIES:
                     logger.info("Retrying...")
                     continue
-                return None
+                raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
+
+            usage = full_json_response.get("usage") if isinstance(full_json_response, dict) else None
+            if on_usage and usage:
+                try:
+                    on_usage(full_json_response.get("model") or model, usage)
+                except Exception as e:
+                    logger.error(f"Attempt {attempt + 1}: Failed to record token usage: {e}", exc_info=True)
 
             try:
                 llm_message_content_str = full_json_response.get("choices", [{}])[0].get("message", {}).get("content")
@@ -184,13 +218,13 @@ All string values within "structured_summary" (key_points, summaries, alerts) MU
                     if attempt < MAX_RETRIES:
                         logger.info("Retrying...")
                         continue
-                    return None
+                    raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
             except (IndexError, AttributeError, TypeError) as e:
                 logger.error(f"Attempt {attempt + 1}: Error extracting LLM message content. Error: {e}. Full response: {json.dumps(full_json_response)}")
                 if attempt < MAX_RETRIES:
                     logger.info("Retrying...")
                     continue
-                return None
+                raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
 
             try:
                 parsed_llm_content = json.loads(llm_message_content_str)
@@ -200,13 +234,13 @@ All string values within "structured_summary" (key_points, summaries, alerts) MU
                     if attempt < MAX_RETRIES:
                         logger.info("Retrying...")
                         continue
-                    return None
+                    raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
             except json.JSONDecodeError as e:
                 logger.error(f"Attempt {attempt + 1}: Failed to parse LLM's message content as JSON. Error: {e}. LLM content (first 500 chars): {llm_message_content_str[:500]}")
                 if attempt < MAX_RETRIES:
                     logger.info("Retrying...")
                     continue
-                return None
+                raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
             
             if _is_valid_summary_format(summary_data, language):
                 logger.info(f"Successfully summarized and validated ToS for {url} in {language} on attempt {attempt + 1}.")
@@ -217,29 +251,35 @@ All string values within "structured_summary" (key_points, summaries, alerts) MU
                     logger.info("Retrying due to validation failure...")
                     continue
                 logger.error("Validation failed after all retries.")
-                return None
+                raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
 
+        except SummarizationError:
+            raise
         except requests.exceptions.Timeout:
             logger.error(f"Attempt {attempt + 1}: OpenRouter API request timed out after 90 seconds.")
             if attempt < MAX_RETRIES:
                 logger.info("Retrying API request after timeout...")
                 continue
-            return None
+            # Usually caused by this document, e.g. a very long ToS, rather than an outage
+            raise SummarizationError(TIMED_OUT, "Summarization timed out")
         except requests.exceptions.RequestException as e:
             logger.error(f"Attempt {attempt + 1}: OpenRouter API request failed: {e}")
+            if e.response is not None and e.response.status_code == 413:
+                # Retrying the same oversized payload cannot succeed
+                raise SummarizationError(OVERSIZED, "Content is too large for the summarization model")
             if attempt < MAX_RETRIES:
                 logger.info("Retrying API request...")
                 continue
-            return None
+            raise SummarizationError(UPSTREAM_UNAVAILABLE, "Summarization service is unavailable")
         except Exception as e:
             logger.error(f"Attempt {attempt + 1}: An unexpected error occurred: {e}", exc_info=True)
             if attempt < MAX_RETRIES:
                 logger.info("Retrying due to unexpected error...")
                 continue
-            return None
+            raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
                 
-    logger.error(f"Exhausted all {MAX_RETRIES + 1} retries for {url} in {language}. Returning None.")
-    return None
+    logger.error(f"Exhausted all {MAX_RETRIES + 1} retries for {url} in {language}.")
+    raise SummarizationError(INVALID_OUTPUT, "The model did not return a valid summary")
 
 def get_available_models() -> List[Dict[str, Any]]:
     """
@@ -248,7 +288,7 @@ def get_available_models() -> List[Dict[str, Any]]:
     Returns:
         List of available models
     """
-    if not OPENROUTER_API_KEY:
+    if not get_api_key():
         logger.warning("OpenRouter API key not found. Set OPENROUTER_API_KEY in .env file.")
         return []
     
@@ -266,11 +306,14 @@ def get_available_models() -> List[Dict[str, Any]]:
 
 # Example usage (for testing this module directly)
 if __name__ == '__main__':
+    from dotenv import load_dotenv
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
     # Ensure OPENROUTER_API_KEY is set in your .env file or environment
-    if not OPENROUTER_API_KEY:
+    if not get_api_key():
         print("Error: OPENROUTER_API_KEY is not set. Please set it in your .env file or environment variables to run this example.")
     else:
-        print(f"Using OpenRouter API Key: ...{OPENROUTER_API_KEY[-4:]}") # Print last 4 chars for confirmation
+        print(f"Using OpenRouter API Key: ...{get_api_key()[-4:]}") # Print last 4 chars for confirmation
         sample_tos = """
         TERMS OF SERVICE FOR EXAMPLE COMPANY
 
@@ -290,17 +333,17 @@ if __name__ == '__main__':
         """
         
         print("\nRequesting English Summary...")
-        summary_en = summarize_terms(sample_tos, "example.com", "http://example.com/tos", "en")
-        if summary_en:
+        try:
+            summary_en = summarize_terms(sample_tos, "example.com", "http://example.com/tos", "en")
             print("\n--- English Summary (structured_summary) ---")
             print(json.dumps(summary_en, indent=2, ensure_ascii=False))
-        else:
-            print("\nFailed to get English summary after retries.")
+        except SummarizationError as e:
+            print(f"\nFailed to get English summary after retries ({e.reason}): {e}")
 
         print("\nRequesting Spanish Summary...")
-        summary_es = summarize_terms(sample_tos, "example.com", "http://example.com/tos", "es")
-        if summary_es:
+        try:
+            summary_es = summarize_terms(sample_tos, "example.com", "http://example.com/tos", "es")
             print("\n--- Spanish Summary (structured_summary) ---")
             print(json.dumps(summary_es, indent=2, ensure_ascii=False))
-        else:
-            print("\nFailed to get Spanish summary after retries.")
+        except SummarizationError as e:
+            print(f"\nFailed to get Spanish summary after retries ({e.reason}): {e}")
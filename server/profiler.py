@@ -0,0 +1,134 @@
+"""
+On-demand sampling profiler for Yoola
+Samples the stacks of threads serving selected requests and aggregates them in the
+folded format understood by flamegraph.pl, speedscope and similar tools
+"""
+import os
+import sys
+import random
+import logging
+import functools
+import threading
+import contextvars
+from collections import Counter
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests profiled without being asked to, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv("YOOLA_PROFILE_SAMPLE_RATE", "0"))
+# Time between two stack samples of a profiled request
+PROFILE_INTERVAL = float(os.getenv("YOOLA_PROFILE_INTERVAL_MS", "5")) / 1000
+# Deepest stack recorded, anything below is cut off
+MAX_STACK_DEPTH = 128
+
+# Set for the duration of a request that should be profiled
+profile_requested = contextvars.ContextVar("profile_requested", default=False)
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").rsplit("/", 2)
+    return f"{'/'.join(path[-2:])}:{getattr(code, 'co_qualname', code.co_name)}"
+
+class SamplingProfiler:
+    """
+    Samples the stacks of registered threads from a background thread while any are registered
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._threads: Dict[int, int] = {}
+        self._stacks = Counter()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+
+    def should_profile(self, requested: bool) -> bool:
+        """Profile when explicitly requested, otherwise for a random PROFILE_SAMPLE_RATE share of requests"""
+        return requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+    def register(self, thread_id: int):
+        """Start sampling thread_id, until a matching unregister"""
+        with self._lock:
+            self._threads[thread_id] = self._threads.get(thread_id, 0) + 1
+            self._requests += 1
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="yoola-profiler", daemon=True)
+                self._thread.start()
+            elif len(self._threads) == 1 and self._threads[thread_id] == 1:
+                # Only an idle sampler needs waking, and it waits an interval before its first sample
+                self._wakeup.notify()
+
+    def unregister(self, thread_id: int):
+        with self._lock:
+            remaining = self._threads.get(thread_id, 0) - 1
+            if remaining > 0:
+                self._threads[thread_id] = remaining
+            else:
+                self._threads.pop(thread_id, None)
+
+    def folded(self) -> str:
+        """Aggregated stacks, one 'root;...;leaf count' line per distinct stack"""
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "profiled_requests": self._requests,
+                "samples": sum(self._stacks.values()),
+                "distinct_stacks": len(self._stacks),
+            }
+
+    def reset(self):
+        """Drop everything collected so far"""
+        with self._lock:
+            self._stacks.clear()
+            self._requests = 0
+
+    def _sample(self):
+        frames = sys._current_frames()
+        for thread_id in list(self._threads):
+            frame = frames.get(thread_id)
+            if frame is None or frame.f_code.co_filename == __file__:
+                # Still in register or unregister, which is profiler time rather than request time
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                # Leave out the profiled wrapper so stacks show only application code
+                if frame.f_code.co_filename != __file__:
+                    names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self._stacks[";".join(reversed(names))] += 1
+
+    def _run(self):
+        with self._lock:
+            while True:
+                # Sleep until a profiled request is running, then sample it every interval,
+                # releasing the lock in between
+                while not self._threads:
+                    self._wakeup.wait()
+                self._wakeup.wait(self.interval)
+                self._sample()
+
+profiler = SamplingProfiler()
+
+def profiled(func):
+    """
+    Decorator for synchronous endpoints: samples the thread running func
+    whenever the current request was selected for profiling
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profile_requested.get():
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        profiler.register(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.unregister(thread_id)
+    return wrapper
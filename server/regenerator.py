@@ -0,0 +1,142 @@
+"""
+Background regeneration of outdated summaries for Yoola
+Summaries produced by an older model or prompt are served as-is while this module
+regenerates them at a limited rate, so an upgrade never turns into a burst of LLM calls
+"""
+import os
+import queue
+import logging
+import threading
+from typing import Optional, Set, Tuple
+
+from openrouter_api import summarize_terms, SummarizationError, DEFAULT_MODEL, PROMPT_VERSION
+from database.db import get_summary_entry, claim_regeneration, reserve_regeneration_slot
+from database.writer import summary_writer
+from cache import negative_cache, summary_cache
+from usage import usage_tracker, usage_domain, SERVER_CLIENT_ID
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of regenerations started per minute, across all workers using the same database
+REGENERATE_PER_MINUTE = float(os.getenv("YOOLA_REGENERATE_PER_MINUTE", "6"))
+# How long a worker's claim on a summary keeps other workers from regenerating it
+REGENERATE_CLAIM_SECONDS = 600
+# Stale summaries requested while the queue is full are simply served stale again later
+REGENERATE_QUEUE_SIZE = int(os.getenv("YOOLA_REGENERATE_QUEUE_SIZE", "1000"))
+
+_STOP = object()
+
+class SummaryRegenerator:
+    """
+    Rate-limited background worker that refreshes summaries to the current model and prompt version
+    """
+
+    def __init__(self, per_minute: float = REGENERATE_PER_MINUTE, max_queued: int = REGENERATE_QUEUE_SIZE):
+        self.interval = 60.0 / per_minute if per_minute > 0 else None
+        self._queue = queue.Queue(maxsize=max_queued)
+        # Keys that are queued or being regenerated, so a hot document is only scheduled once
+        self._scheduled: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the regeneration thread unless regeneration is disabled"""
+        if self.interval is None:
+            logger.info("Background regeneration is disabled (YOOLA_REGENERATE_PER_MINUTE=0)")
+            return
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="yoola-summary-regenerator", daemon=True)
+        self._thread.start()
+        logger.info(f"Summary regenerator started ({60.0 / self.interval:g} per minute)")
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """Stop after the regeneration in progress, dropping anything still queued"""
+        if not self._thread:
+            return
+        self._stopping.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Summary regenerator did not stop within {timeout} seconds, abandoning the regeneration in progress")
+        self._thread = None
+
+    def depth(self) -> int:
+        """Number of summaries scheduled for regeneration"""
+        with self._lock:
+            return len(self._scheduled)
+
+    def schedule(self, content: str, content_hash: str, domain: str, url: str, language: str) -> bool:
+        """
+        Schedule a stale summary for regeneration
+
+        Returns:
+            True if the summary is scheduled (now or earlier), False if it was dropped
+        """
+        key = (content_hash, language)
+        with self._lock:
+            if key in self._scheduled:
+                return True
+            if not self._thread:
+                return False
+            try:
+                self._queue.put_nowait((content, content_hash, domain, url, language))
+            except queue.Full:
+                logger.warning(f"Regeneration queue is full, not scheduling hash '{content_hash}' in language '{language}'")
+                return False
+            self._scheduled.add(key)
+        return True
+
+    def _regenerate(self, content: str, content_hash: str, domain: str, url: str, language: str):
+        key = (content_hash, language)
+        # The summary may have been served from a memory cache after another instance refreshed it
+        entry = get_summary_entry(content_hash=content_hash, language=language)
+        if entry and (entry["model"], entry["prompt_version"]) == (DEFAULT_MODEL, PROMPT_VERSION):
+            summary_cache.put(key, entry)
+            logger.info(f"Summary for hash '{content_hash}' in language '{language}' is already current")
+            return
+        if negative_cache.get(key):
+            logger.info(f"Skipping regeneration of hash '{content_hash}' in language '{language}', it is backing off")
+            return
+        if not claim_regeneration(content_hash, language, REGENERATE_CLAIM_SECONDS):
+            logger.info(f"Skipping regeneration of hash '{content_hash}' in language '{language}', another worker claimed it")
+            return
+        # Space regenerations out evenly across all workers instead of letting them burst
+        if self._stopping.wait(reserve_regeneration_slot(self.interval)):
+            return
+        on_usage = lambda model, usage: usage_tracker.record(client_address=SERVER_CLIENT_ID, client_id=SERVER_CLIENT_ID, domain=usage_domain(url),
+                                                             model=model, usage=usage, content_hash=content_hash, language=language)
+        try:
+            summary_data = summarize_terms(content=content, domain=domain, url=url, language=language, on_usage=on_usage)
+        except SummarizationError as e:
+            negative_cache.record_failure(key, e.reason)
+            logger.warning(f"Regeneration of hash '{content_hash}' in language '{language}' failed: {e}")
+            return
+        negative_cache.record_success(key)
+        summary_writer.enqueue(content=content, content_hash=content_hash, summary_data=summary_data, url=url,
+                               language=language, model=DEFAULT_MODEL, prompt_version=PROMPT_VERSION, request_count=0)
+        summary_cache.put(key, {"summary": summary_data, "model": DEFAULT_MODEL, "prompt_version": PROMPT_VERSION})
+        logger.info(f"Regenerated summary for hash '{content_hash}' in language '{language}'")
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            try:
+                self._regenerate(*job)
+            except Exception as e:
+                logger.error(f"Unexpected error during regeneration: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._scheduled.discard((job[1], job[4]))
+        logger.info("Summary regenerator stopped")
+
+summary_regenerator = SummaryRegenerator()
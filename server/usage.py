@@ -0,0 +1,238 @@
+"""
+LLM usage accounting and budgets for Yoola
+Records the tokens and estimated cost of every OpenRouter call per client, domain and model,
+and refuses new LLM calls for clients or domains that exceeded their daily budget
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from database.db import canonicalize_url, get_usage_totals
+from database.writer import summary_writer
+
+logger = logging.getLogger(__name__)
+
+# Daily budgets per UTC day; 0 means unlimited
+CLIENT_DAILY_TOKENS = int(os.getenv("YOOLA_CLIENT_DAILY_TOKENS", "0"))
+CLIENT_DAILY_COST_USD = float(os.getenv("YOOLA_CLIENT_DAILY_COST_USD", "0"))
+DOMAIN_DAILY_TOKENS = int(os.getenv("YOOLA_DOMAIN_DAILY_TOKENS", "0"))
+DOMAIN_DAILY_COST_USD = float(os.getenv("YOOLA_DOMAIN_DAILY_COST_USD", "0"))
+# Totals are re-read from the rollup this often, so budgets hold across several workers
+BUDGET_REFRESH_SECONDS = float(os.getenv("YOOLA_BUDGET_REFRESH_SECONDS", "30"))
+# LLM calls one client address may have in flight at once; 0 means unlimited
+CLIENT_MAX_CONCURRENT_CALLS = int(os.getenv("YOOLA_CLIENT_MAX_CONCURRENT_CALLS", "2"))
+# Seconds a client at its concurrency limit is asked to wait, about the length of one LLM call
+CONCURRENCY_RETRY_AFTER = 10
+# Until a call reports its usage it counts as its prompt, at about this many characters per
+# token, plus the largest completion openrouter_api asks for
+CHARS_PER_TOKEN = 4
+RESERVED_COMPLETION_TOKENS = 2500
+# Fallback prices when OpenRouter does not report a cost, as
+# {"model": [USD per million prompt tokens, USD per million completion tokens]}
+MODEL_PRICES = json.loads(os.getenv("YOOLA_MODEL_PRICES", "{}"))
+
+# Client id used for LLM calls the server makes on its own, e.g. background regeneration
+SERVER_CLIENT_ID = "yoola-server"
+
+class BudgetExceeded(Exception):
+    """
+    Raised by UsageTracker.reserve when a client or domain may not start another LLM call
+    """
+
+    def __init__(self, reason: str, scope: str, retry_after: float, message: str):
+        super().__init__(message)
+        # "budget_exceeded" or "too_many_calls"
+        self.reason = reason
+        # "client_address" or "domain"
+        self.scope = scope
+        self.retry_after = retry_after
+
+class Reservation:
+    """
+    An admitted LLM call, counted against the budgets at its estimated usage until it is settled
+    """
+
+    def __init__(self, client_address: str, domain: str, tokens: int, cost: float):
+        self.client_address = client_address
+        self.domain = domain
+        self.tokens = tokens
+        self.cost = cost
+        self.settled = False
+
+def estimate_cost(model: str, usage: Dict[str, Any]) -> float:
+    """
+    Cost of one call in USD: the cost OpenRouter reports, otherwise an estimate from MODEL_PRICES
+    """
+    if isinstance(usage.get("cost"), (int, float)):
+        return float(usage["cost"])
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+    return (usage.get("prompt_tokens", 0) * prompt_price + usage.get("completion_tokens", 0) * completion_price) / 1_000_000
+
+def estimate_usage(content: str) -> Dict[str, int]:
+    """Usage to reserve for summarizing content, before the call reports the real one"""
+    return {"prompt_tokens": len(content) // CHARS_PER_TOKEN, "completion_tokens": RESERVED_COMPLETION_TOKENS}
+
+def usage_domain(url: str) -> str:
+    """
+    Domain that usage is accounted to and budgeted by: the host of the page's URL. The domain
+    parameter is whatever the client claims, so it could spread usage over made-up domains.
+    """
+    _, domain_path = canonicalize_url(url)
+    return domain_path.split("/", 1)[0] if domain_path else "unknown"
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+def _seconds_until_tomorrow() -> float:
+    now = datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (tomorrow - now).total_seconds()
+
+class UsageTracker:
+    """
+    Records LLM usage through the summary writer and keeps today's totals per client and domain in memory,
+    together with the estimated usage of calls still in flight
+    """
+
+    def __init__(self):
+        # (scope, key) -> [day, tokens, cost, loaded at]
+        self._totals: Dict[Tuple[str, str], list] = {}
+        # (scope, key) -> [tokens, cost, calls] reserved by calls that have not reported their usage yet
+        self._reserved: Dict[Tuple[str, str], list] = {}
+        # client address -> LLM calls in flight
+        self._calls = Counter()
+        self._lock = threading.Lock()
+
+    def _entry(self, scope: str, key: str, day: str) -> list:
+        with self._lock:
+            entry = self._totals.get((scope, key))
+            if entry and entry[0] == day and time.monotonic() - entry[3] < BUDGET_REFRESH_SECONDS:
+                return entry
+        # Usage still buffered in the writer is not in the rollup yet. Read it before the rollup: a record
+        # committed in between is then counted twice, which errs on the safe side, rather than not at all.
+        unflushed = [
+            record for record in summary_writer.pending_usage()
+            if record[scope] == key and datetime.fromtimestamp(record["created_at"], timezone.utc).strftime("%Y-%m-%d") == day
+        ]
+        tokens, cost = get_usage_totals(day, **{scope: key})
+        tokens += sum(record["prompt_tokens"] + record["completion_tokens"] for record in unflushed)
+        cost += sum(record["cost_usd"] for record in unflushed)
+        entry = [day, tokens, cost, time.monotonic()]
+        with self._lock:
+            self._totals[(scope, key)] = entry
+        return entry
+
+    def _over_budget(self, client_address: str, domain: str, day: str) -> Optional[Tuple[str, float]]:
+        """Compare spent plus reserved usage with the budgets; the caller holds the lock and loaded the totals"""
+        limits = (
+            ("client_address", client_address, CLIENT_DAILY_TOKENS, CLIENT_DAILY_COST_USD),
+            ("domain", domain, DOMAIN_DAILY_TOKENS, DOMAIN_DAILY_COST_USD),
+        )
+        for scope, key, max_tokens, max_cost in limits:
+            if not max_tokens and not max_cost:
+                continue
+            _, tokens, cost, _ = self._totals[(scope, key)]
+            reserved_tokens, reserved_cost, _ = self._reserved.get((scope, key), (0, 0.0, 0))
+            if (max_tokens and tokens + reserved_tokens >= max_tokens) or (max_cost and cost + reserved_cost >= max_cost):
+                logger.warning(f"Daily LLM budget exhausted for {scope} '{key}': {tokens} tokens, ${cost:.4f} "
+                               f"spent and {reserved_tokens} tokens, ${reserved_cost:.4f} reserved")
+                return scope, _seconds_until_tomorrow()
+        return None
+
+    def reserve(self, client_address: str, domain: str, model: str, usage: Dict[str, Any]) -> Reservation:
+        """
+        Admit one LLM call for this client address and domain, counting usage (an estimate, see
+        estimate_usage) against both budgets until the call settles it through record.
+        Every reservation must be handed to release once the call is over.
+
+        Raises:
+            BudgetExceeded: If a budget is spent, or the client has too many calls in flight
+        """
+        day = _today()
+        if CLIENT_DAILY_TOKENS or CLIENT_DAILY_COST_USD:
+            self._entry("client_address", client_address, day)
+        if DOMAIN_DAILY_TOKENS or DOMAIN_DAILY_COST_USD:
+            self._entry("domain", domain, day)
+        reservation = Reservation(client_address, domain, int(usage.get("prompt_tokens", 0)) + int(usage.get("completion_tokens", 0)),
+                                  estimate_cost(model, usage))
+        with self._lock:
+            # Checking and reserving under one lock keeps concurrent requests from all passing the same check
+            over_budget = self._over_budget(client_address, domain, day)
+            if over_budget:
+                scope, retry_after = over_budget
+                raise BudgetExceeded("budget_exceeded", scope, retry_after,
+                                     f"Daily summarization budget exceeded for this {'client' if scope == 'client_address' else 'domain'}")
+            if CLIENT_MAX_CONCURRENT_CALLS and self._calls[client_address] >= CLIENT_MAX_CONCURRENT_CALLS:
+                logger.warning(f"Client {client_address} already has {self._calls[client_address]} LLM calls in flight")
+                raise BudgetExceeded("too_many_calls", "client_address", CONCURRENCY_RETRY_AFTER,
+                                     "Too many summaries are being generated for this client at once")
+            self._calls[client_address] += 1
+            for entry_key in (("client_address", client_address), ("domain", domain)):
+                reserved = self._reserved.setdefault(entry_key, [0, 0.0, 0])
+                reserved[0] += reservation.tokens
+                reserved[1] += reservation.cost
+                reserved[2] += 1
+        return reservation
+
+    def _settle(self, reservation: Reservation):
+        """Stop counting the reservation's estimate; the caller holds the lock"""
+        if reservation.settled:
+            return
+        reservation.settled = True
+        for entry_key in (("client_address", reservation.client_address), ("domain", reservation.domain)):
+            reserved = self._reserved[entry_key]
+            reserved[0] -= reservation.tokens
+            reserved[1] -= reservation.cost
+            reserved[2] -= 1
+            if not reserved[2]:
+                del self._reserved[entry_key]
+
+    def release(self, reservation: Reservation):
+        """End a call admitted by reserve, whether or not it reported any usage"""
+        with self._lock:
+            self._settle(reservation)
+            self._calls[reservation.client_address] -= 1
+            if self._calls[reservation.client_address] <= 0:
+                del self._calls[reservation.client_address]
+
+    def record(self, client_address: str, client_id: str, domain: str, model: str, usage: Dict[str, Any],
+               content_hash: Optional[str] = None, language: Optional[str] = None, reservation: Optional[Reservation] = None):
+        """
+        Account for one OpenRouter response; suitable as summarize_terms' on_usage callback.
+        Budgets apply to client_address; client_id only breaks its usage down in the rollup.
+        The real usage replaces the estimate held by reservation, if any.
+        """
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        cost = estimate_cost(model, usage)
+        now = time.time()
+        summary_writer.record_usage({
+            "created_at": now,
+            "client_address": client_address,
+            "client_id": client_id,
+            "domain": domain,
+            "model": model,
+            "content_hash": content_hash,
+            "language": language,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": cost,
+        })
+        day = datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%d")
+        with self._lock:
+            if reservation:
+                self._settle(reservation)
+            for entry_key in (("client_address", client_address), ("domain", domain)):
+                entry = self._totals.get(entry_key)
+                if entry and entry[0] == day:
+                    entry[1] += prompt_tokens + completion_tokens
+                    entry[2] += cost
+        logger.info(f"LLM usage for client '{client_id}' at {client_address} on '{domain}' with {model}: "
+                    f"{prompt_tokens}+{completion_tokens} tokens, ${cost:.6f}")
+
+usage_tracker = UsageTracker()
@@ -0,0 +1,110 @@
+"""
+Cache warm-up for Yoola
+Preloads the most-requested summaries into the in-memory summary cache when the server starts,
+from a snapshot file written by earlier instances, so new instances take traffic hot instead of cold
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from database.db import DB_DIR, get_hot_summaries
+from cache import summary_cache
+
+logger = logging.getLogger(__name__)
+
+# Snapshot of the most-requested summaries, shared by every instance using the same database
+WARMUP_SNAPSHOT_PATH = os.getenv("YOOLA_WARMUP_SNAPSHOT", os.path.join(DB_DIR, "hot_summaries.json"))
+# Number of summaries preloaded, 0 disables warm-up
+WARMUP_TOP_N = int(os.getenv("YOOLA_WARMUP_TOP_N", "1000"))
+# Older snapshots are replaced by a fresh one read from the database
+WARMUP_SNAPSHOT_MAX_AGE = float(os.getenv("YOOLA_WARMUP_SNAPSHOT_MAX_AGE", "86400"))
+
+class CacheWarmer:
+    """
+    Preloads summary_cache in a background thread and reports when it is done
+    """
+
+    def __init__(self, snapshot_path: str = WARMUP_SNAPSHOT_PATH, top_n: int = WARMUP_TOP_N):
+        self.snapshot_path = snapshot_path
+        self.top_n = top_n
+        self._ready = threading.Event()
+        self._status: Dict[str, Any] = {"source": None, "preloaded": 0, "seconds": None}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start warming up; ready() turns true once the cache is filled or warm-up failed"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name="yoola-cache-warmer", daemon=True)
+        self._thread.start()
+
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready(), **self._status}
+
+    def save_snapshot(self, entries: Optional[List[Dict[str, Any]]] = None):
+        """
+        Write the most-requested summaries to the snapshot file for the next instances
+
+        Args:
+            entries: Summaries as returned by get_hot_summaries, read from the database if None
+        """
+        if self.top_n <= 0:
+            return
+        try:
+            if entries is None:
+                entries = get_hot_summaries(self.top_n)
+            # Write next to the target and rename, so instances starting meanwhile never read half a file
+            temp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({"created_at": time.time(), "summaries": entries}, f)
+            os.replace(temp_path, self.snapshot_path)
+            logger.info(f"Wrote {len(entries)} summaries to cache snapshot {self.snapshot_path}")
+        except Exception as e:
+            logger.error(f"Failed to write cache snapshot {self.snapshot_path}: {e}")
+
+    def _read_snapshot(self) -> Optional[List[Dict[str, Any]]]:
+        """Summaries from the snapshot file, or None if it is missing, outdated or unreadable"""
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache snapshot {self.snapshot_path}: {e}")
+            return None
+        age = time.time() - snapshot.get("created_at", 0)
+        if age > WARMUP_SNAPSHOT_MAX_AGE:
+            logger.info(f"Ignoring cache snapshot {self.snapshot_path}, it is {age:.0f} seconds old")
+            return None
+        return snapshot.get("summaries", [])[:self.top_n]
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            if self.top_n > 0:
+                entries = self._read_snapshot()
+                source = "snapshot"
+                if entries is None:
+                    entries = get_hot_summaries(self.top_n)
+                    source = "database"
+                self._status["source"] = source
+                self._status["preloaded"] = summary_cache.preload(entries)
+                logger.info(f"Preloaded {self._status['preloaded']} summaries from the {source}")
+                if source == "database":
+                    # Instances starting later can read the snapshot instead of querying the database
+                    self.save_snapshot(entries)
+        except Exception as e:
+            # A cold cache is slower, not broken, so the instance still becomes ready
+            logger.error(f"Cache warm-up failed, starting with a cold cache: {e}")
+        finally:
+            self._status["seconds"] = round(time.time() - start_time, 3)
+            self._ready.set()
+
+cache_warmer = CacheWarmer()
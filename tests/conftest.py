@@ -0,0 +1,46 @@
+"""
+Shared fixtures for the Yoola server tests
+"""
+import os
+import sys
+
+import pytest
+
+# Add the server directory to the path to allow importing modules
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+
+import database.db as db
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Point the database module at an empty SQLite file and return its path"""
+    path = str(tmp_path / "yoola.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(db, "_schema_migrated", False)
+    return path
+
+@pytest.fixture
+def api(temp_db, monkeypatch):
+    """
+    Return a TestClient for the app. The lifespan is not run, so no background thread starts,
+    and every in-memory singleton is replaced with a fresh one.
+    """
+    from fastapi.testclient import TestClient
+
+    import main
+    import usage
+    from cache import NegativeCache, SummaryCache
+    from database.writer import SummaryWriter
+    from regenerator import SummaryRegenerator
+    from usage import UsageTracker
+
+    db.ensure_schema()
+    monkeypatch.setenv("YOOLA_ADMIN_TOKEN", "secret")
+    writer = SummaryWriter()
+    monkeypatch.setattr(main, "summary_writer", writer)
+    monkeypatch.setattr(usage, "summary_writer", writer)
+    monkeypatch.setattr(main, "summary_cache", SummaryCache())
+    monkeypatch.setattr(main, "negative_cache", NegativeCache())
+    monkeypatch.setattr(main, "summary_regenerator", SummaryRegenerator())
+    monkeypatch.setattr(main, "usage_tracker", UsageTracker())
+    return TestClient(main.app)
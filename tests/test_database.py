@@ -0,0 +1,123 @@
+"""
+Tests for database/db.py: batched writes, request counts and schema migration
+"""
+import sqlite3
+
+import pytest
+
+import database.db as db
+from database.db import compute_content_hash
+
+# Schema created by the first ddl.sql, before any migration
+LEGACY_DDL = """
+CREATE TABLE yoola (
+  id            INTEGER PRIMARY KEY,
+  content       TEXT    NOT NULL,
+  url           TEXT,
+  content_hash  TEXT
+);
+CREATE TABLE languages (
+  language  TEXT PRIMARY KEY,
+  picture   BLOB
+);
+CREATE TABLE yoola_lang_summary (
+  yoola_id     INTEGER NOT NULL,
+  language     TEXT    NOT NULL,
+  summary      JSON    NOT NULL,
+  request_num  INTEGER NOT NULL,
+  PRIMARY KEY (yoola_id, language)
+);
+CREATE INDEX idx_yoola_content_hash ON yoola(content_hash);
+CREATE INDEX idx_yls_summary        ON yoola_lang_summary(summary);
+"""
+
+def summary_item(content, summary_data, url="https://example.com/tos", language="English", **extra):
+    return {
+        "content": content,
+        "content_hash": compute_content_hash(content),
+        "url": url,
+        "language": language,
+        "summary_data": summary_data,
+        "model": "model-a",
+        "prompt_version": "1",
+        **extra,
+    }
+
+def write(items):
+    conn = db.get_db_connection()
+    try:
+        return db.upsert_summaries(conn, items)
+    finally:
+        conn.close()
+
+def request_num(content, language="English"):
+    conn = db.get_db_connection()
+    try:
+        return conn.execute(
+            "SELECT s.request_num FROM yoola_lang_summary s JOIN yoola y ON s.yoola_id = y.id WHERE y.content_hash = ? AND s.language = ?",
+            (compute_content_hash(content), language)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+def test_upsert_summaries_inserts_and_updates(temp_db):
+    assert write([summary_item("terms", {"points": ["v1"]})]) == 1
+    assert write([summary_item("terms", {"points": ["v2"]}, model="model-b", request_count=2)]) == 1
+
+    entry = db.get_summary_entry(compute_content_hash("terms"), "English")
+    assert entry == {"summary": {"points": ["v2"]}, "model": "model-b", "prompt_version": "1"}
+    assert request_num("terms") == 3
+
+def test_upsert_summaries_without_request_count_change(temp_db):
+    write([summary_item("terms", {"points": ["v1"]})])
+    write([summary_item("terms", {"points": ["v2"]}, request_count=0)])
+    assert request_num("terms") == 1
+
+def test_record_hits(temp_db):
+    write([summary_item("terms", {"points": ["v1"]}), summary_item("other", {"points": ["v1"]})])
+    conn = db.get_db_connection()
+    try:
+        db.record_hits(conn, {(compute_content_hash("terms"), "English"): 4, ("unknown", "English"): 1})
+    finally:
+        conn.close()
+    assert request_num("terms") == 5
+    assert request_num("other") == 1
+
+def test_migration_merges_duplicate_documents(temp_db):
+    conn = sqlite3.connect(temp_db)
+    conn.executescript(LEGACY_DDL)
+    conn.executemany("INSERT INTO languages VALUES (?, NULL)", [("English",), ("Russian",)])
+    conn.executemany(
+        "INSERT INTO yoola (id, content, url, content_hash) VALUES (?, ?, ?, ?)",
+        [(1, "terms", "https://example.com/tos", "h"), (2, "terms", "https://example.com/tos", "h"), (3, "other", None, "g")]
+    )
+    conn.executemany(
+        "INSERT INTO yoola_lang_summary VALUES (?, ?, ?, ?)",
+        [(1, "English", "null", 2), (2, "English", '{"points": ["kept"]}', 3), (2, "Russian", '{"points": ["moved"]}', 1),
+         (3, "English", '{"points": ["other"]}', 5)]
+    )
+    conn.commit()
+    conn.close()
+
+    db.ensure_schema()
+
+    conn = sqlite3.connect(temp_db)
+    try:
+        assert conn.execute("SELECT id, content_hash FROM yoola ORDER BY id").fetchall() == [(1, "h"), (3, "g")]
+        assert conn.execute("SELECT yoola_id, language, summary, request_num FROM yoola_lang_summary ORDER BY yoola_id, language").fetchall() == [
+            (1, "English", '{"points": ["kept"]}', 5),
+            (1, "Russian", '{"points": ["moved"]}', 1),
+            (3, "English", '{"points": ["other"]}', 5),
+        ]
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO yoola (content, content_hash) VALUES ('terms', 'h')")
+    finally:
+        conn.close()
+    assert db.get_summary_entry("h", "English") == {"summary": {"points": ["kept"]}, "model": None, "prompt_version": None}
+    assert db.get_latest_summary_by_url("https://www.example.com/tos", "English")["content_hash"] == "h"
+
+def test_schema_setup_is_idempotent(temp_db):
+    db.ensure_schema()
+    write([summary_item("terms", {"points": ["v1"]})])
+    db.initialize_schema()
+    assert db.get_summary_entry(compute_content_hash("terms"), "English")["summary"] == {"points": ["v1"]}
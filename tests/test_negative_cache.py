@@ -0,0 +1,102 @@
+"""
+Tests for the negative cache in cache.py and the failure responses of GET /get_summary
+"""
+import pytest
+
+import cache
+import database.db as db
+from cache import NegativeCache
+from database.db import compute_content_hash
+from openrouter_api import SummarizationError, OVERSIZED, UPSTREAM_UNAVAILABLE, TIMED_OUT, INVALID_OUTPUT
+
+DOCUMENT = ("hash", "English")
+OTHER_DOCUMENT = ("other", "English")
+
+class Clock:
+    """Stands in for time.monotonic so that backoffs can expire without sleeping"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+def test_backoff_doubles_up_to_the_maximum(clock):
+    negative_cache = NegativeCache()
+    initial, maximum = cache.NEGATIVE_CACHE_BACKOFF[INVALID_OUTPUT]
+    ttls = []
+    for _ in range(8):
+        ttls.append(negative_cache.record_failure(DOCUMENT, INVALID_OUTPUT))
+        clock.now += ttls[-1]
+    assert ttls[:3] == [initial, 2 * initial, 4 * initial]
+    assert ttls[-1] == maximum
+
+def test_backoff_expires_and_is_forgotten(clock):
+    negative_cache = NegativeCache()
+    ttl = negative_cache.record_failure(DOCUMENT, OVERSIZED)
+    assert negative_cache.get(DOCUMENT) == (OVERSIZED, ttl)
+    clock.now += ttl
+    assert negative_cache.get(DOCUMENT) is None
+    # Long after the backoff ended the failure no longer counts as consecutive
+    clock.now += 2 * ttl
+    assert negative_cache.record_failure(DOCUMENT, OVERSIZED) == ttl
+
+def test_upstream_outage_blocks_every_document(clock):
+    negative_cache = NegativeCache()
+    negative_cache.record_failure(DOCUMENT, UPSTREAM_UNAVAILABLE)
+    assert negative_cache.get(OTHER_DOCUMENT)[0] == UPSTREAM_UNAVAILABLE
+    assert negative_cache.stats()[UPSTREAM_UNAVAILABLE] == 1
+
+def test_timeouts_only_block_their_document(clock):
+    negative_cache = NegativeCache()
+    negative_cache.record_failure(DOCUMENT, TIMED_OUT)
+    assert negative_cache.get(DOCUMENT)[0] == TIMED_OUT
+    assert negative_cache.get(OTHER_DOCUMENT) is None
+
+def test_success_ends_an_upstream_outage(clock):
+    negative_cache = NegativeCache()
+    initial, _ = cache.NEGATIVE_CACHE_BACKOFF[UPSTREAM_UNAVAILABLE]
+    negative_cache.record_failure(DOCUMENT, UPSTREAM_UNAVAILABLE)
+    clock.now += initial
+    negative_cache.record_success(OTHER_DOCUMENT)
+    assert negative_cache.get(DOCUMENT) is None
+    # The next outage starts over from the initial backoff
+    assert negative_cache.record_failure(DOCUMENT, UPSTREAM_UNAVAILABLE) == initial
+
+def test_negative_cache_is_bounded(clock):
+    negative_cache = NegativeCache(max_entries=2)
+    for content_hash in ("a", "b", "c"):
+        negative_cache.record_failure((content_hash, "English"), OVERSIZED)
+    assert negative_cache.get(("a", "English")) is None
+    assert negative_cache.get(("c", "English"))[0] == OVERSIZED
+
+@pytest.mark.parametrize("reason, status", [
+    (OVERSIZED, 413),
+    (INVALID_OUTPUT, 502),
+    (UPSTREAM_UNAVAILABLE, 503),
+    (TIMED_OUT, 504),
+])
+def test_failures_are_answered_from_the_backoff(api, monkeypatch, reason, status):
+    calls = []
+
+    def fail(**kwargs):
+        calls.append(kwargs["content"])
+        raise SummarizationError(reason, "Summary failed")
+
+    monkeypatch.setattr("main.summarize_terms", fail)
+    params = {"content": "terms", "domain": "example.com", "url": "https://example.com/tos", "language": "English"}
+    for _ in range(2):
+        response = api.get("/get_summary", params=params)
+        assert response.status_code == status
+        assert response.json()["detail"]["reason"] == reason
+        assert 0 < int(response.headers["Retry-After"]) <= cache.NEGATIVE_CACHE_BACKOFF[reason][0]
+    # The second request waited out the backoff instead of calling the LLM, and nothing was stored
+    assert calls == ["terms"]
+    assert api.get("/metrics").json()["write_queue_depth"] == 0
+    assert db.get_summary_entry(compute_content_hash("terms"), "English") is None
@@ -0,0 +1,64 @@
+"""
+Tests for the on-demand sampling profiler in profiler.py
+"""
+import time
+
+import profiler as profiler_module
+from profiler import SamplingProfiler, profiled, profile_requested
+
+def busy_work(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+def profile(profiler, func, *args, monkeypatch):
+    """Run func the way an endpoint decorated with @profiled runs for a request selected for profiling"""
+    monkeypatch.setattr(profiler_module, "profiler", profiler)
+    token = profile_requested.set(True)
+    try:
+        profiled(func)(*args)
+    finally:
+        profile_requested.reset(token)
+
+def test_samples_show_application_code_only(monkeypatch):
+    profiler = SamplingProfiler(interval=0.001)
+    profile(profiler, busy_work, 0.2, monkeypatch=monkeypatch)
+
+    counts = {}
+    for line in profiler.folded().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        counts[stack] = int(count)
+    frames = {frame for stack in counts for frame in stack.split(";")}
+    assert not any(frame.startswith("server/profiler.py:") for frame in frames)
+    busy = sum(count for stack, count in counts.items() if stack.endswith("test_profiler.py:busy_work"))
+    assert busy > sum(counts.values()) / 2
+    assert profiler.stats()["profiled_requests"] == 1
+
+def test_sampler_sleeps_while_nothing_is_profiled(monkeypatch):
+    profiler = SamplingProfiler(interval=0.001)
+    profile(profiler, busy_work, 0.05, monkeypatch=monkeypatch)
+    samples = profiler.stats()["samples"]
+    time.sleep(0.05)
+    assert profiler.stats()["samples"] == samples
+
+    # A later request wakes the sampler up again
+    profile(profiler, busy_work, 0.05, monkeypatch=monkeypatch)
+    assert profiler.stats()["samples"] > samples
+
+def test_reset(monkeypatch):
+    profiler = SamplingProfiler(interval=0.001)
+    profile(profiler, busy_work, 0.05, monkeypatch=monkeypatch)
+    profiler.reset()
+    assert profiler.stats() == {"profiled_requests": 0, "samples": 0, "distinct_stacks": 0}
+
+def test_profile_endpoints_require_admin(api):
+    assert api.get("/admin/profile").status_code == 403
+    assert api.delete("/admin/profile").status_code == 403
+
+    admin = {"X-Yoola-Admin-Token": "secret"}
+    response = api.get("/lookup", params={"url": "https://example.com/tos", "language": "English"}, headers={"X-Yoola-Profile": "1"})
+    assert "X-Yoola-Profiled" not in response.headers
+    response = api.get("/lookup", params={"url": "https://example.com/tos", "language": "English"}, headers={"X-Yoola-Profile": "1", **admin})
+    assert response.headers["X-Yoola-Profiled"] == "1"
+    assert api.get("/admin/profile", headers=admin).status_code == 200
+    assert api.delete("/admin/profile", headers=admin).json() == {"reset": True}
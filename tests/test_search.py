@@ -0,0 +1,116 @@
+"""
+Tests for full-text search: the FTS5 indexes in database/search.sql and GET /search
+"""
+import sqlite3
+
+import pytest
+
+import database.db as db
+from database.db import compute_content_hash
+
+@pytest.fixture
+def search_db(temp_db):
+    db.ensure_schema()
+    if not db.search_available:
+        pytest.skip("SQLite lacks FTS5")
+    return temp_db
+
+def summary_item(content, summary_data, url="https://example.com/tos", language="English"):
+    return {
+        "content": content,
+        "content_hash": compute_content_hash(content),
+        "url": url,
+        "language": language,
+        "summary_data": summary_data,
+        "model": "model-a",
+        "prompt_version": "1",
+    }
+
+def write(*items):
+    conn = db.get_db_connection()
+    try:
+        db.upsert_summaries(conn, items)
+    finally:
+        conn.close()
+
+def test_search_index_follows_writes(search_db):
+    write(summary_item("Disputes go to binding arbitration", {"alerts": ["Forced arbitration"]}))
+    write(summary_item("We never sell your data", {"alerts": ["none"]}, url="https://other.com/tos"))
+
+    results = db.search_documents("arbitrate", scope="tos")
+    assert [result["domain_path"] for result in results] == ["example.com/tos"]
+    assert "[arbitration]" in results[0]["snippet"]
+    assert "url" not in results[0]
+    assert len(db.search_documents("arbitration", scope="summaries", language="English")) == 1
+
+    # Updating a summary replaces its indexed text
+    write(summary_item("Disputes go to binding arbitration", {"alerts": ["Class action waiver"]}))
+    assert db.search_documents("arbitration", scope="summaries") == []
+    assert len(db.search_documents("waiver", scope="summaries")) == 1
+
+    with pytest.raises(ValueError):
+        db.search_documents("AND", scope="tos")
+
+def test_summary_index_survives_vacuum(search_db):
+    write(summary_item("first terms", {"alerts": ["Forced arbitration"]}, url="https://first.com/tos"))
+    write(summary_item("second terms", {"alerts": ["Sells your data"]}, url="https://second.com/tos"))
+    conn = sqlite3.connect(search_db, isolation_level=None)
+    try:
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("DELETE FROM yoola WHERE content = 'first terms'")
+        conn.execute("VACUUM")
+        # Indexed rows are keyed on the summary's primary key, which VACUUM never renumbers
+        assert conn.execute("SELECT rowid FROM yoola_summary_fts").fetchall() == conn.execute("SELECT id FROM yoola_lang_summary").fetchall()
+    finally:
+        conn.close()
+
+    write(summary_item("second terms", {"alerts": ["Class action waiver"]}, url="https://second.com/tos"))
+    assert db.search_documents("arbitration", scope="summaries") == []
+    assert db.search_documents("sells", scope="summaries") == []
+    assert [result["domain_path"] for result in db.search_documents("waiver", scope="summaries")] == ["second.com/tos"]
+
+def test_summaries_stored_before_the_primary_key_are_indexed(temp_db):
+    conn = sqlite3.connect(temp_db)
+    conn.executescript(
+        """
+        CREATE TABLE yoola (id INTEGER PRIMARY KEY, content TEXT NOT NULL, url TEXT, content_hash TEXT);
+        CREATE TABLE languages (language TEXT PRIMARY KEY, picture BLOB);
+        CREATE TABLE yoola_lang_summary (
+          yoola_id INTEGER NOT NULL, language TEXT NOT NULL, summary JSON NOT NULL, request_num INTEGER NOT NULL,
+          PRIMARY KEY (yoola_id, language)
+        );
+        INSERT INTO languages VALUES ('English', NULL);
+        INSERT INTO yoola VALUES (1, 'terms', 'https://example.com/tos', 'h');
+        INSERT INTO yoola_lang_summary VALUES (1, 'English', '{"alerts": ["Forced arbitration"]}', 3);
+        """
+    )
+    conn.close()
+
+    db.ensure_schema()
+    if not db.search_available:
+        pytest.skip("SQLite lacks FTS5")
+    conn = sqlite3.connect(temp_db)
+    try:
+        assert conn.execute("SELECT id, yoola_id, language, request_num FROM yoola_lang_summary").fetchall() == [(1, 1, "English", 3)]
+    finally:
+        conn.close()
+    assert len(db.search_documents("arbitration", scope="summaries")) == 1
+
+def test_search_endpoint(api, monkeypatch):
+    if not db.search_available:
+        pytest.skip("SQLite lacks FTS5")
+    write(summary_item("Disputes go to binding arbitration", {"alerts": ["Forced arbitration"]}))
+    assert api.get("/search", params={"q": "arbitration"}).status_code == 403
+    assert api.get("/search", params={"q": "arbitration"}, headers={"X-Yoola-Admin-Token": "wrong"}).status_code == 403
+
+    admin = {"X-Yoola-Admin-Token": "secret"}
+    body = api.get("/search", params={"q": "arbitration"}, headers=admin).json()
+    assert [result["domain_path"] for result in body["results"]] == ["example.com/tos"]
+    assert body["has_more"] is False
+    assert api.get("/search", params={"q": "AND"}, headers=admin).status_code == 400
+
+    def locked(*args, **kwargs):
+        raise RuntimeError("Full-text search is temporarily unavailable")
+
+    monkeypatch.setattr("main.search_documents", locked)
+    assert api.get("/search", params={"q": "arbitration"}, headers=admin).status_code == 503
@@ -0,0 +1,152 @@
+"""
+Tests for LLM usage budgets in usage.py
+"""
+import time
+
+import pytest
+
+import usage
+import database.db as db
+from database.writer import SummaryWriter
+from openrouter_api import SummarizationError, INVALID_OUTPUT
+from usage import BudgetExceeded, UsageTracker
+
+@pytest.fixture
+def tracker(temp_db, monkeypatch):
+    monkeypatch.setattr(usage, "CLIENT_DAILY_TOKENS", 100)
+    monkeypatch.setattr(usage, "CLIENT_DAILY_COST_USD", 0)
+    monkeypatch.setattr(usage, "DOMAIN_DAILY_TOKENS", 0)
+    monkeypatch.setattr(usage, "DOMAIN_DAILY_COST_USD", 0.05)
+    monkeypatch.setattr(usage, "CLIENT_MAX_CONCURRENT_CALLS", 0)
+    monkeypatch.setattr(usage, "summary_writer", SummaryWriter())
+    return UsageTracker()
+
+def refused_scope(tracker, client_address, domain="example.com", tokens=0):
+    """Try to start a call; return the scope of the budget that refused it, or None after ending it again"""
+    try:
+        reservation = tracker.reserve(client_address=client_address, domain=domain, model="model-a",
+                                      usage={"prompt_tokens": tokens, "completion_tokens": 0})
+    except BudgetExceeded as e:
+        return e.scope
+    tracker.release(reservation)
+    return None
+
+def store_usage(client_address, domain, tokens, cost):
+    conn = db.get_db_connection()
+    try:
+        db.record_usage(conn, [{
+            "created_at": time.time(), "client_address": client_address, "client_id": "any", "domain": domain,
+            "model": "model-a", "content_hash": None, "language": None,
+            "prompt_tokens": tokens, "completion_tokens": 0, "cost_usd": cost,
+        }])
+    finally:
+        conn.close()
+
+def test_within_budget(tracker):
+    store_usage("10.0.0.1", "example.com", 50, 0.01)
+    assert refused_scope(tracker, "10.0.0.1") is None
+
+def test_client_budget_applies_per_address(tracker):
+    store_usage("10.0.0.1", "example.com", 100, 0.01)
+    with pytest.raises(BudgetExceeded) as refused:
+        tracker.reserve(client_address="10.0.0.1", domain="example.com", model="model-a", usage={})
+    assert (refused.value.reason, refused.value.scope) == ("budget_exceeded", "client_address")
+    assert 0 < refused.value.retry_after <= 24 * 3600
+    assert refused_scope(tracker, "10.0.0.2") is None
+
+def test_domain_cost_budget(tracker):
+    store_usage("10.0.0.1", "example.com", 10, 0.03)
+    store_usage("10.0.0.2", "example.com", 10, 0.03)
+    assert refused_scope(tracker, "10.0.0.3", domain="example.com") == "domain"
+    assert refused_scope(tracker, "10.0.0.3", domain="other.com") is None
+
+def test_recorded_usage_counts_before_it_is_persisted(tracker):
+    assert refused_scope(tracker, "10.0.0.1") is None
+    tracker.record(client_address="10.0.0.1", client_id="abc", domain="example.com", model="model-a",
+                   usage={"prompt_tokens": 90, "completion_tokens": 20})
+    assert refused_scope(tracker, "10.0.0.1") == "client_address"
+
+def test_unflushed_usage_counts_when_totals_are_reloaded(tracker, monkeypatch):
+    monkeypatch.setattr(usage, "BUDGET_REFRESH_SECONDS", 0)
+    tracker.record(client_address="10.0.0.1", client_id="abc", domain="example.com", model="model-a",
+                   usage={"prompt_tokens": 90, "completion_tokens": 20})
+    # The writer is not running, so the record is still buffered and the rollup is empty
+    assert db.get_usage_totals(usage._today(), client_address="10.0.0.1") == (0, 0)
+    assert refused_scope(UsageTracker(), "10.0.0.1") == "client_address"
+
+def test_calls_in_flight_count_at_their_estimate_until_settled(tracker):
+    first = tracker.reserve(client_address="10.0.0.1", domain="example.com", model="model-a", usage={"prompt_tokens": 60})
+    second = tracker.reserve(client_address="10.0.0.1", domain="example.com", model="model-a", usage={"prompt_tokens": 60})
+    # 120 tokens are reserved, so no further call may start even though nothing was spent yet
+    assert refused_scope(tracker, "10.0.0.1") == "client_address"
+
+    # The real usage replaces the estimate as soon as it is reported
+    tracker.record(client_address="10.0.0.1", client_id="abc", domain="example.com", model="model-a",
+                   usage={"prompt_tokens": 10, "completion_tokens": 5}, reservation=first)
+    tracker.release(first)
+    tracker.release(second)
+    assert refused_scope(tracker, "10.0.0.1", tokens=60) is None
+    assert refused_scope(tracker, "10.0.0.1") is None
+
+def test_concurrent_calls_are_capped_per_address(tracker, monkeypatch):
+    monkeypatch.setattr(usage, "CLIENT_MAX_CONCURRENT_CALLS", 1)
+    reservation = tracker.reserve(client_address="10.0.0.1", domain="example.com", model="model-a", usage={})
+    with pytest.raises(BudgetExceeded) as refused:
+        tracker.reserve(client_address="10.0.0.1", domain="example.com", model="model-a", usage={})
+    assert refused.value.reason == "too_many_calls"
+    assert refused_scope(tracker, "10.0.0.2") is None
+    tracker.release(reservation)
+    assert refused_scope(tracker, "10.0.0.1") is None
+
+def test_reported_cost_wins_over_estimate(monkeypatch):
+    monkeypatch.setattr(usage, "MODEL_PRICES", {"model-a": [1.0, 2.0]})
+    assert usage.estimate_cost("model-a", {"prompt_tokens": 1000, "completion_tokens": 1000, "cost": 0.5}) == 0.5
+    assert usage.estimate_cost("model-a", {"prompt_tokens": 1000, "completion_tokens": 1000}) == pytest.approx(0.003)
+    assert usage.estimate_cost("unknown", {"prompt_tokens": 1000}) == 0
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.Example.com/tos?utm_source=x", "example.com"),
+    ("https://example.com:8443/tos", "example.com:8443"),
+    ("ftp://example.com/tos", "unknown"),
+])
+def test_usage_domain(url, expected):
+    assert usage.usage_domain(url) == expected
+
+def test_domain_budget_follows_the_url_not_the_claimed_domain(api, monkeypatch):
+    monkeypatch.setattr(usage, "DOMAIN_DAILY_TOKENS", 100)
+    monkeypatch.setattr("main.summarize_terms", lambda **kwargs: {"points": ["generated"]})
+    store_usage("10.0.0.9", "example.com", 100, 0)
+
+    response = api.get("/get_summary", params={"content": "terms", "domain": "unrelated.org", "url": "https://www.example.com/tos", "language": "English"})
+    assert response.status_code == 429
+    assert response.json()["detail"]["reason"] == "budget_exceeded"
+    assert 0 < int(response.headers["Retry-After"]) <= 24 * 3600
+
+    response = api.get("/get_summary", params={"content": "terms", "domain": "example.com", "url": "https://other.com/tos", "language": "English"})
+    assert response.json() == {"points": ["generated"]}
+
+def test_failed_calls_release_their_reservation(api, monkeypatch):
+    monkeypatch.setattr(usage, "CLIENT_MAX_CONCURRENT_CALLS", 1)
+    monkeypatch.setattr(usage, "CLIENT_DAILY_TOKENS", 10000)
+
+    def fail(**kwargs):
+        kwargs["on_usage"]("model-a", {"prompt_tokens": 100, "completion_tokens": 0})
+        raise SummarizationError(INVALID_OUTPUT, "Unusable output")
+
+    monkeypatch.setattr("main.summarize_terms", fail)
+    for content in ("first terms", "second terms"):
+        response = api.get("/get_summary", params={"content": content, "domain": "example.com", "url": "https://example.com/tos", "language": "English"})
+        assert response.status_code == 502
+    assert db.get_usage_totals(usage._today(), client_address="testclient") == (0, 0)
+    assert [record["prompt_tokens"] for record in usage.summary_writer.pending_usage()] == [100, 100]
+
+def test_usage_report_endpoint(api):
+    store_usage("10.0.0.1", "example.com", 100, 0.02)
+    store_usage("10.0.0.2", "example.com", 50, 0.01)
+    assert api.get("/admin/usage").status_code == 403
+
+    admin = {"X-Yoola-Admin-Token": "secret"}
+    assert api.get("/admin/usage", params={"group_by": "content"}, headers=admin).status_code == 422
+    body = api.get("/admin/usage", params={"group_by": "client_address"}, headers=admin).json()
+    assert body["day"] == usage._today()
+    assert [row["client_address"] for row in body["rows"]] == ["10.0.0.1", "10.0.0.2"]
@@ -0,0 +1,143 @@
+"""
+Tests for model/prompt versioned summaries: stale responses, SummaryRegenerator and upgrade progress
+"""
+import time
+
+import pytest
+
+import database.db as db
+import regenerator
+import usage
+from cache import NegativeCache, SummaryCache
+from database.db import compute_content_hash
+from database.writer import SummaryWriter
+from openrouter_api import SummarizationError, INVALID_OUTPUT, DEFAULT_MODEL, PROMPT_VERSION
+from regenerator import SummaryRegenerator
+
+CONTENT = "terms"
+CONTENT_HASH = compute_content_hash(CONTENT)
+
+def store(model, prompt_version, content=CONTENT):
+    conn = db.get_db_connection()
+    try:
+        db.upsert_summaries(conn, [{
+            "content": content, "content_hash": compute_content_hash(content), "url": "https://example.com/tos",
+            "language": "English", "summary_data": {"points": [f"{model} {prompt_version}"]},
+            "model": model, "prompt_version": prompt_version, "request_count": 3,
+        }])
+    finally:
+        conn.close()
+
+@pytest.fixture
+def llm_calls(temp_db, monkeypatch):
+    """Replace the regenerator's LLM, writer and caches; the returned list collects the summarized contents"""
+    calls = []
+
+    def summarize(**kwargs):
+        calls.append(kwargs["content"])
+        kwargs["on_usage"]("model-a", {"prompt_tokens": 100, "completion_tokens": 20})
+        return {"points": ["regenerated"]}
+
+    writer = SummaryWriter(flush_interval=0.01)
+    monkeypatch.setattr(regenerator, "summarize_terms", summarize)
+    monkeypatch.setattr(regenerator, "summary_writer", writer)
+    monkeypatch.setattr(usage, "summary_writer", writer)
+    monkeypatch.setattr(regenerator, "summary_cache", SummaryCache())
+    monkeypatch.setattr(regenerator, "negative_cache", NegativeCache())
+    writer.start()
+    yield calls
+    writer.stop(timeout=5)
+
+def regenerate(*keys):
+    """Run a fast SummaryRegenerator over the given (content, content_hash) pairs until it is done"""
+    summary_regenerator = SummaryRegenerator(per_minute=6000)
+    summary_regenerator.start()
+    try:
+        for content, content_hash in keys:
+            summary_regenerator.schedule(content=content, content_hash=content_hash, domain="example.com",
+                                         url="https://example.com/tos", language="English")
+        deadline = time.monotonic() + 5
+        while summary_regenerator.depth() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        summary_regenerator.stop()
+
+def test_stale_summary_is_regenerated_without_counting_a_request(llm_calls):
+    store("old-model", "0")
+    regenerate((CONTENT, CONTENT_HASH), (CONTENT, CONTENT_HASH))
+    regenerator.summary_writer.stop(timeout=5)
+
+    assert llm_calls == [CONTENT]
+    entry = db.get_summary_entry(CONTENT_HASH, "English")
+    assert entry == {"summary": {"points": ["regenerated"]}, "model": DEFAULT_MODEL, "prompt_version": PROMPT_VERSION}
+    assert regenerator.summary_cache.get((CONTENT_HASH, "English")) == entry
+    assert db.get_version_progress(DEFAULT_MODEL, PROMPT_VERSION)["hot_summaries"] == 1
+    conn = db.get_db_connection()
+    try:
+        assert conn.execute("SELECT request_num FROM yoola_lang_summary").fetchone()[0] == 3
+    finally:
+        conn.close()
+    # The server pays for regenerations, not the client whose request found the summary stale
+    assert db.get_usage_totals(usage._today(), client_address=usage.SERVER_CLIENT_ID) == (120, 0)
+    assert db.get_usage_totals(usage._today(), domain="example.com") == (120, 0)
+
+def test_summary_refreshed_elsewhere_is_not_regenerated(llm_calls):
+    store(DEFAULT_MODEL, PROMPT_VERSION)
+    regenerate((CONTENT, CONTENT_HASH))
+    assert llm_calls == []
+    assert regenerator.summary_cache.get((CONTENT_HASH, "English"))["model"] == DEFAULT_MODEL
+
+def test_summary_claimed_by_another_worker_is_skipped(llm_calls):
+    store("old-model", "0")
+    assert db.claim_regeneration(CONTENT_HASH, "English", ttl=60)
+    regenerate((CONTENT, CONTENT_HASH))
+    assert llm_calls == []
+
+def test_failed_regeneration_keeps_the_stale_summary(llm_calls, monkeypatch):
+    store("old-model", "0")
+
+    def fail(**kwargs):
+        raise SummarizationError(INVALID_OUTPUT, "Unusable output")
+
+    monkeypatch.setattr(regenerator, "summarize_terms", fail)
+    regenerate((CONTENT, CONTENT_HASH))
+    regenerator.summary_writer.flush()
+    assert db.get_summary_entry(CONTENT_HASH, "English")["model"] == "old-model"
+    assert regenerator.negative_cache.get((CONTENT_HASH, "English"))[0] == INVALID_OUTPUT
+
+def test_schedule_needs_a_running_regenerator():
+    assert SummaryRegenerator().schedule(content=CONTENT, content_hash=CONTENT_HASH, domain="example.com",
+                                         url="https://example.com/tos", language="English") is False
+
+def test_stale_summary_is_served_with_a_header(api):
+    store("old-model", "0")
+    store(DEFAULT_MODEL, PROMPT_VERSION, content="current terms")
+    params = {"domain": "example.com", "url": "https://example.com/tos", "language": "English"}
+
+    response = api.get("/get_summary", params={"content": CONTENT, **params})
+    assert response.json() == {"points": ["old-model 0"]}
+    assert response.headers["X-Yoola-Stale"] == "1"
+    response = api.get("/get_summary", params={"content": "current terms", **params})
+    assert response.status_code == 200
+    assert "X-Yoola-Stale" not in response.headers
+
+def test_upgrade_progress_skips_legacy_null_rows(temp_db):
+    store(DEFAULT_MODEL, PROMPT_VERSION)
+    store("old-model", "0", content="failed terms")
+    conn = db.get_db_connection()
+    try:
+        conn.execute("UPDATE yoola_lang_summary SET request_num = 10, summary = 'null' WHERE model = 'old-model'")
+        conn.commit()
+    finally:
+        conn.close()
+    assert db.get_version_progress(DEFAULT_MODEL, PROMPT_VERSION) == {"hot_summaries": 1, "on_current_version": 1, "share_current": 1.0}
+
+def test_upgrade_progress_endpoint(api):
+    store("old-model", "0")
+    assert api.get("/admin/upgrade_progress").status_code == 403
+
+    admin = {"X-Yoola-Admin-Token": "secret"}
+    assert api.get("/admin/upgrade_progress", params={"top": -1}, headers=admin).status_code == 422
+    body = api.get("/admin/upgrade_progress", params={"top": 10}, headers=admin).json()
+    assert (body["hot_summaries"], body["on_current_version"]) == (1, 0)
+    assert body["current_version"] == {"model": DEFAULT_MODEL, "prompt_version": PROMPT_VERSION}
@@ -0,0 +1,128 @@
+"""
+Tests for startup warm-up: the summary cache in cache.py, CacheWarmer in warmup.py and GET /ready
+"""
+import json
+import time
+
+import pytest
+
+import database.db as db
+import warmup
+from cache import SummaryCache
+from database.db import compute_content_hash
+from warmup import CacheWarmer
+
+def summary_item(content):
+    return {
+        "content": content, "content_hash": compute_content_hash(content), "url": "https://example.com/tos",
+        "language": "English", "summary_data": {"points": [content]}, "model": "model-a", "prompt_version": "1",
+    }
+
+def write(*items):
+    conn = db.get_db_connection()
+    try:
+        db.upsert_summaries(conn, items)
+    finally:
+        conn.close()
+
+def wait_until_ready(warmer):
+    deadline = time.monotonic() + 5
+    while not warmer.ready() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return warmer.ready()
+
+@pytest.fixture
+def summary_cache(monkeypatch):
+    summary_cache = SummaryCache()
+    monkeypatch.setattr(warmup, "summary_cache", summary_cache)
+    return summary_cache
+
+def test_summary_cache_evicts_least_recently_used():
+    summary_cache = SummaryCache(max_entries=2)
+    summary_cache.put(("a", "en"), {"summary": "a"})
+    summary_cache.put(("b", "en"), {"summary": "b"})
+    summary_cache.get(("a", "en"))
+    summary_cache.put(("c", "en"), {"summary": "c"})
+    assert summary_cache.get(("b", "en")) is None
+    assert summary_cache.get(("a", "en")) == {"summary": "a"}
+    assert summary_cache.stats() == {"entries": 2, "hits": 2, "misses": 1}
+
+def test_preload_keeps_the_hottest_and_skips_missing_summaries():
+    summary_cache = SummaryCache(max_entries=3)
+    summary_cache.put(("requested", "en"), {"summary": "fresh", "model": "m", "prompt_version": "1"})
+    entries = [
+        {"content_hash": content_hash, "language": "en", "summary": summary, "model": "m", "prompt_version": "1"}
+        for content_hash, summary in (("hot", "hot"), ("requested", "old"), ("legacy", None), ("warm", "warm"), ("cold", "cold"))
+    ]
+    assert summary_cache.preload(entries) == 2
+    assert summary_cache.get(("requested", "en"))["summary"] == "fresh"
+    assert summary_cache.get(("hot", "en"))["summary"] == "hot"
+    assert summary_cache.get(("legacy", "en")) is None
+
+def test_hot_summaries_skip_legacy_null_rows(temp_db):
+    write(summary_item("terms"), summary_item("failed"))
+    conn = db.get_db_connection()
+    try:
+        conn.execute("UPDATE yoola_lang_summary SET request_num = 10, summary = 'null' WHERE yoola_id = (SELECT id FROM yoola WHERE content = 'failed')")
+        conn.commit()
+    finally:
+        conn.close()
+    assert [entry["summary"] for entry in db.get_hot_summaries(10)] == [{"points": ["terms"]}]
+
+def test_snapshot_round_trip(temp_db, tmp_path, summary_cache, monkeypatch):
+    write(summary_item("terms"), summary_item("other terms"))
+    snapshot_path = str(tmp_path / "hot_summaries.json")
+
+    first = CacheWarmer(snapshot_path=snapshot_path, top_n=10)
+    first.start()
+    assert wait_until_ready(first)
+    assert (first.status()["source"], first.status()["preloaded"]) == ("database", 2)
+    with open(snapshot_path) as f:
+        assert len(json.load(f)["summaries"]) == 2
+
+    # The next instance starts from the snapshot without reading the database
+    def unavailable(limit):
+        raise AssertionError("the database should not be read")
+
+    monkeypatch.setattr(warmup, "get_hot_summaries", unavailable)
+    cache = SummaryCache()
+    monkeypatch.setattr(warmup, "summary_cache", cache)
+    second = CacheWarmer(snapshot_path=snapshot_path, top_n=10)
+    second.start()
+    assert wait_until_ready(second)
+    assert (second.status()["source"], second.status()["preloaded"]) == ("snapshot", 2)
+    assert cache.get((compute_content_hash("terms"), "English"))["summary"] == {"points": ["terms"]}
+
+@pytest.mark.parametrize("snapshot", ['{"created_at": 0, "summaries": []}', "not json"])
+def test_outdated_or_unreadable_snapshot_is_replaced(temp_db, tmp_path, summary_cache, snapshot):
+    write(summary_item("terms"))
+    snapshot_path = tmp_path / "hot_summaries.json"
+    snapshot_path.write_text(snapshot)
+    warmer = CacheWarmer(snapshot_path=str(snapshot_path), top_n=10)
+    warmer.start()
+    assert wait_until_ready(warmer)
+    assert (warmer.status()["source"], warmer.status()["preloaded"]) == ("database", 1)
+    assert len(json.loads(snapshot_path.read_text())["summaries"]) == 1
+
+def test_failed_warm_up_still_becomes_ready(temp_db, tmp_path, summary_cache, monkeypatch):
+    def unavailable(limit):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(warmup, "get_hot_summaries", unavailable)
+    warmer = CacheWarmer(snapshot_path=str(tmp_path / "missing.json"), top_n=10)
+    warmer.start()
+    assert wait_until_ready(warmer)
+    assert warmer.status()["preloaded"] == 0
+
+def test_ready_endpoint_waits_for_warm_up(api, tmp_path, summary_cache, monkeypatch):
+    warmer = CacheWarmer(snapshot_path=str(tmp_path / "hot_summaries.json"), top_n=10)
+    monkeypatch.setattr("main.cache_warmer", warmer)
+    response = api.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["ready"] is False
+
+    warmer.start()
+    assert wait_until_ready(warmer)
+    response = api.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["ready"] is True
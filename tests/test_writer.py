@@ -0,0 +1,128 @@
+"""
+Tests for the background summary writer in database/writer.py
+"""
+import sqlite3
+
+import database.db as db
+import database.writer as writer_module
+from database.db import compute_content_hash
+from database.writer import SummaryWriter
+
+def test_pending_summary_is_served_until_persisted(temp_db):
+    writer = SummaryWriter(batch_size=8, flush_interval=0.01)
+    content_hash = compute_content_hash("terms")
+    writer.enqueue(content="terms", content_hash=content_hash, summary_data={"points": ["v1"]},
+                   url="https://example.com/tos", language="English", model="model-a", prompt_version="1")
+
+    # Not started yet, so the summary only exists in memory
+    assert writer.get_pending(content_hash, "English") == {"points": ["v1"]}
+    assert writer.depth() == 1
+
+    writer.start()
+    try:
+        writer.flush()
+        assert writer.get_pending(content_hash, "English") is None
+        assert writer.depth() == 0
+        assert db.get_summary_entry(content_hash, "English") == {"summary": {"points": ["v1"]}, "model": "model-a", "prompt_version": "1"}
+    finally:
+        writer.stop(timeout=5)
+
+def test_latest_summary_for_a_key_wins(temp_db):
+    writer = SummaryWriter(batch_size=8, flush_interval=0.01)
+    content_hash = compute_content_hash("terms")
+    for version in ("v1", "v2", "v3"):
+        writer.enqueue(content="terms", content_hash=content_hash, summary_data={"points": [version]}, language="English")
+    assert writer.get_pending(content_hash, "English") == {"points": ["v3"]}
+
+    writer.start()
+    writer.stop(timeout=5)
+    assert db.get_summary_entry(content_hash, "English")["summary"] == {"points": ["v3"]}
+
+def test_hits_and_usage_are_persisted_on_stop(temp_db):
+    writer = SummaryWriter(batch_size=8, flush_interval=0.01)
+    content_hash = compute_content_hash("terms")
+    writer.start()
+    writer.enqueue(content="terms", content_hash=content_hash, summary_data={"points": ["v1"]}, language="English")
+    writer.flush()
+    for _ in range(3):
+        writer.record_hit(content_hash, "English")
+    writer.record_usage({
+        "created_at": 1750000000.0, "client_address": "10.0.0.1", "client_id": "abc", "domain": "example.com",
+        "model": "model-a", "content_hash": content_hash, "language": "English",
+        "prompt_tokens": 100, "completion_tokens": 20, "cost_usd": 0.01,
+    })
+    writer.stop(timeout=5)
+
+    conn = db.get_db_connection()
+    try:
+        assert conn.execute("SELECT request_num FROM yoola_lang_summary").fetchone()[0] == 4
+    finally:
+        conn.close()
+    assert db.get_usage_totals("2025-06-15", client_address="10.0.0.1") == (120, 0.01)
+    assert db.get_usage_totals("2025-06-15", domain="example.com") == (120, 0.01)
+
+def test_locked_database_is_retried_instead_of_dropping(temp_db, monkeypatch):
+    real_upsert, real_record_usage = writer_module.upsert_summaries, writer_module.record_usage
+    failures = {"upsert": 2, "usage": 2}
+
+    def locked_once(name, write):
+        def attempt(conn, items):
+            if failures[name]:
+                failures[name] -= 1
+                raise sqlite3.OperationalError("database is locked")
+            return write(conn, items)
+        return attempt
+
+    monkeypatch.setattr(writer_module, "upsert_summaries", locked_once("upsert", real_upsert))
+    monkeypatch.setattr(writer_module, "record_usage", locked_once("usage", real_record_usage))
+    writer = SummaryWriter(batch_size=8, flush_interval=0.01)
+    content_hash = compute_content_hash("terms")
+    writer.enqueue(content="terms", content_hash=content_hash, summary_data={"points": ["v1"]}, language="English")
+    writer.record_usage({
+        "created_at": 1750000000.0, "client_address": "10.0.0.1", "client_id": "abc", "domain": "example.com",
+        "model": "model-a", "content_hash": content_hash, "language": "English",
+        "prompt_tokens": 100, "completion_tokens": 20, "cost_usd": 0.01,
+    })
+    assert len(writer.pending_usage()) == 1
+    writer.start()
+    writer.stop(timeout=5)
+
+    assert failures == {"upsert": 0, "usage": 0}
+    assert db.get_summary_entry(content_hash, "English")["summary"] == {"points": ["v1"]}
+    assert db.get_usage_totals("2025-06-15", client_address="10.0.0.1") == (120, 0.01)
+    assert writer.pending_usage() == []
+
+def test_non_transient_errors_drop_only_the_failing_summary(temp_db, monkeypatch):
+    real_upsert = writer_module.upsert_summaries
+
+    def reject_bad(conn, items):
+        if any(item["content"] == "bad" for item in items):
+            raise sqlite3.IntegrityError("constraint failed")
+        return real_upsert(conn, items)
+
+    monkeypatch.setattr(writer_module, "upsert_summaries", reject_bad)
+    writer = SummaryWriter(batch_size=8, flush_interval=0.01)
+    for content in ("good", "bad"):
+        writer.enqueue(content=content, content_hash=compute_content_hash(content), summary_data={"points": [content]}, language="English")
+    writer.start()
+    writer.stop(timeout=5)
+
+    assert db.get_summary_entry(compute_content_hash("good"), "English")["summary"] == {"points": ["good"]}
+    assert db.get_summary_entry(compute_content_hash("bad"), "English") is None
+    assert writer.depth() == 0
+
+def test_new_summary_is_answered_before_it_is_persisted(api, monkeypatch):
+    calls = []
+
+    def summarize(**kwargs):
+        calls.append(kwargs["content"])
+        return {"points": ["generated"]}
+
+    monkeypatch.setattr("main.summarize_terms", summarize)
+    params = {"content": "terms", "domain": "example.com", "url": "https://example.com/tos", "language": "English"}
+    assert api.get("/get_summary", params=params).json() == {"points": ["generated"]}
+    # The app's writer is not running, so the summary is only queued
+    assert db.get_summary_entry(compute_content_hash("terms"), "English") is None
+    assert api.get("/metrics").json()["write_queue_depth"] == 1
+    assert api.get("/get_summary", params=params).json() == {"points": ["generated"]}
+    assert calls == ["terms"]